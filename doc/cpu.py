@@ -1,6 +1,6 @@
 # THIS IS AN EXAMPLE KERNEL FOR PHOENIX 2.
 # THOUGH IT IS FULLY FUNCTIONAL, IT IS QUITE SLOW. IT IS INTENDED FOR
-# DEMONSTRATION PURPOSES ONLY.
+# DEMONSTRATION PURPOSES ONLY. (plugins/cpu is the CPU kernel to actually use)
 
 # Additionally, this doesn't demonstrate QueueReader, which is the preferred
 # way of making kernels that dispatch a separate thread to handle NonceRanges
@@ -116,18 +116,24 @@ class PhoenixKernel(object):
             nr = yield d
             # Now we work on nr...
             # This is defined in WorkQueue.py
+            # NOTE: The WorkQueue rolls ntime by handing out ranges of the same
+            # WorkUnit again with a later timestamp, so a range has to be
+            # hashed with nr.timestamp (nr.unit.getData(nr.timestamp) gives
+            # the header to go with it), not the unit's original timestamp.
+            # The interface's convenience functions take care of this when
+            # they are given the NonceRange itself.
             for nonce in xrange(nr.base, nr.base+nr.size):
                 # Here we simply have to test nonce. We can do this ourselves,
                 # but the interface has a convenience function to do this for
                 # us. (It doesn't communicate elsewhere with Phoenix and is
                 # therefore safe to use without reactor.callFromThread)
-                hash = self.interface.calculateHash(nr.unit, nonce)
+                hash = self.interface.calculateHash(nr, nonce)
 
                 # There's also a convenience function for comparing the hash
                 # against the target.
                 if self.interface.checkTarget(hash, nr.unit.target):
                     # It's good! Let's send it in...
-                    reactor.callFromThread(self.interface.foundNonce, nr.unit,
+                    reactor.callFromThread(self.interface.foundNonce, nr,
                                            nonce)
 
                 # Count the nonce we just did, and report the rate, in
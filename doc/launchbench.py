@@ -0,0 +1,108 @@
+# Copyright (C) 2012 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# This is a microbenchmark of the host-side cost of launching the opencl
+# kernel, comparing passing every argument on each launch (as Phoenix used to)
+# with binding the static arguments once and only updating the nonce base.
+#
+# Usage: python doc/launchbench.py [platform:device] [launches]
+#
+# Each launch covers a single work group, so the time measured is almost all
+# spent on the host queueing launches rather than on the device hashing.
+
+import os
+import sys
+import time
+from struct import pack
+
+import numpy as np
+import pyopencl as cl
+
+WORKSIZE = 64
+RESULTS = 32
+
+def main():
+    ids = (sys.argv[1] if len(sys.argv) > 1 else '0:0').split(':')
+    launches = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    device = cl.get_platforms()[int(ids[0])].get_devices()[int(ids[1])]
+    context = cl.Context([device])
+    queue = cl.CommandQueue(context)
+
+    kernelPath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'phoenix2', 'plugins', 'opencl',
+                              'kernel.cl')
+    source = open(kernelPath, 'r').read()
+    program = cl.Program(context, source).build(
+        '-DWORKSIZE=%d -DRESULTS=%d' % (WORKSIZE, RESULTS))
+    kernel = program.search
+
+    # The same flags as the plugin uses; the count is atomically incremented.
+    output = cl.Buffer(context,
+                       cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR |
+                       cl.mem_flags.COPY_HOST_PTR,
+                       hostbuf=np.zeros(RESULTS+1, np.uint32))
+
+    # The values don't matter, only that they're the same types Phoenix uses.
+    state = np.arange(8, dtype=np.uint32)
+    state2 = np.arange(8, dtype=np.uint32)
+    f = np.arange(8, dtype=np.uint32)
+    bases = [pack('I', i * WORKSIZE) for i in range(launches)]
+
+    def everyArgument():
+        for base in bases:
+            kernel(queue, (WORKSIZE, ), (WORKSIZE, ),
+                   state[0], state[1], state[2], state[3],
+                   state[4], state[5], state[6], state[7],
+                   state2[1], state2[2], state2[3],
+                   state2[5], state2[6], state2[7],
+                   base,
+                   f[0], f[1], f[2], f[3], f[4], f[5], f[6], f[7],
+                   output)
+
+    def baseOnly():
+        kernel.set_args(*(list(state) +
+                          [state2[1], state2[2], state2[3],
+                           state2[5], state2[6], state2[7]] +
+                          [bases[0]] + list(f) + [output]))
+        for base in bases:
+            kernel.set_arg(14, base)
+            cl.enqueue_nd_range_kernel(queue, kernel,
+                                       (WORKSIZE, ), (WORKSIZE, ))
+
+    print 'Device: %s' % device.name.strip()
+    for name, run in (('every argument', everyArgument),
+                      ('base only', baseOnly)):
+        # Warm up, so neither side pays for first-launch setup.
+        run()
+        queue.finish()
+
+        started = time.time()
+        run()
+        enqueued = time.time() - started
+        queue.finish()
+        total = time.time() - started
+
+        print '%-16s %7.2f us/launch to enqueue, %7.2f us/launch total' % (
+            name, enqueued / launches * 1e6, total / launches * 1e6)
+
+if __name__ == '__main__':
+    main()
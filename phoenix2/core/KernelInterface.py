@@ -23,17 +23,33 @@ import sys
 import os
 import traceback
 import time
+import threading
 from struct import pack, unpack
+from collections import deque
 from hashlib import sha256
 from twisted.internet import defer, reactor
 from weakref import WeakKeyDictionary
 
 from phoenix2.core.PhoenixLogger import *
+from phoenix2.core.WorkQueue import NonceRange
+from phoenix2.util.Midstate import np, hashNonces
 
 # I'm using this as a sentinel value to indicate that an option has no default;
 # it must be specified.
 REQUIRED = object()
 
+# These are the classifications of a hash found by a kernel, from worst to best.
+RESULT_HWERROR = 0 # Doesn't meet difficulty 1, so the device made a mistake.
+RESULT_DIFF1 = 1 # Meets difficulty 1, but not the target of the WorkUnit.
+RESULT_SHARE = 2 # Meets the target of the WorkUnit.
+RESULT_BLOCK = 3 # Meets the target of the block itself.
+
+# Any hash below this (i.e. with the top 32 bits clear) is difficulty 1.
+DIFF1_LIMIT = 1 << 224
+
+# Batches of at least this many nonces are hashed with NumPy (if available).
+VECTOR_MIN = 8
+
 class KernelOption(object):
     """This works like a property, and is used in defining easy option tables
     for kernels.
@@ -58,6 +74,30 @@ class KernelOption(object):
     def __set__(self, instance, value):
         self.localValues[instance] = value
 
+class RateCounter(object):
+    """A fixed-size ring of rate samples that keeps a running sum, so the
+    average never has to be recalculated from the whole window.
+    """
+
+    def __init__(self, samples):
+        self.samples = deque(maxlen=samples)
+        self.total = 0
+
+    def add(self, rate):
+        if len(self.samples) == self.samples.maxlen:
+            self.total -= self.samples[0]
+        self.samples.append(rate)
+        self.total += rate
+
+    def resize(self, samples):
+        self.samples = deque(self.samples, samples)
+        self.total = sum(self.samples)
+
+    def getRate(self):
+        if self.samples:
+            return self.total/len(self.samples)
+        return 0
+
 class KernelInterface(object):
     """This is an object passed to kernels as an API back to the Phoenix
     framework.
@@ -70,11 +110,29 @@ class KernelInterface(object):
         self.meta = {}
         self._fatal = False
         self.rateCounters = {}
+        self.rate = 0 # The sum of the averages of all rateCounters.
+        self._stopped = False
         self.results = 0
         self.accepted = 0
         self.rejected = 0
+        self.hwerrors = 0
+        self.blocks = 0
+        self.stats = {}
         self.started = time.time()
 
+        # Kernels are constructed in the core's init threads, so anything
+        # that reaches into the core has to be sent back to this one.
+        self._coreThread = threading.current_thread()
+
+    def _callInCore(self, func, *args):
+        """Call func in the core's (reactor) thread: right away if that's
+        the current thread, or as soon as the reactor gets to it otherwise.
+        """
+        if threading.current_thread() is self._coreThread:
+            func(*args)
+        else:
+            reactor.callFromThread(func, *args)
+
     def getDeviceID(self):
         """Kernels should query this first, to get the device identifier."""
         return self.deviceID
@@ -119,36 +177,47 @@ class KernelInterface(object):
 
         self.meta[var] = value
         # TODO: Change this to distinguish between multiple kernels.
-        self.core.setMeta(var, value)
+        self._callInCore(self.core.setMeta, var, value)
+
+    def setStat(self, name, value):
+        """Set a kernel-specific statistic, which is reported with the device
+        in listdevices().
+        """
+
+        self.stats[name] = value
 
     def getRate(self):
         """Get the total rate of this kernel, in khps"""
 
-        total = 0
-        for rc in self.rateCounters.values():
-            if rc:
-                total += sum(rc)/len(rc)
-        return total
+        return self.rate
 
     def updateRate(self, rate, index=None):
-        rc = self.rateCounters.setdefault(index, [])
-        rc.append(rate)
-
-        # Now limit to the sliding window:
-        samples = self.core.config.get('general', 'ratesamples', int, 10)
-        self.rateCounters[index] = rc[-samples:]
-
-        self.core._recalculateTotalRate()
+        samples = self.core.rateSamples
+        rc = self.rateCounters.get(index)
+        if rc is None:
+            rc = self.rateCounters[index] = RateCounter(samples)
+
+        # Resizing changes the average too, so it has to be part of the
+        # difference.
+        old = rc.getRate()
+        if rc.samples.maxlen != samples:
+            rc.resize(samples)
+        rc.add(rate)
+        delta = rc.getRate() - old
+
+        # Only the difference is passed along; the core publishes the fleet
+        # total on its own schedule.
+        self.rate += delta
+        if not self._stopped:
+            self.core.runningRate += delta
 
     def fetchRange(self, size=None):
         """Fetch a range from the WorkQueue, optionally specifying a size
-        (in nonces) to include in the range.
+        (in nonces) to include in the range. Without a size, the WorkQueue
+        sizes the range for this device's hashrate.
         """
 
-        if size is None:
-            return self.core.queue.fetchRange()
-        else:
-            return self.core.queue.fetchRange(size)
+        return self.core.queue.fetchRange(size, self)
 
     def fetchUnit(self):
         """Fetch a raw WorkUnit directly from the WorkQueue."""
@@ -161,14 +230,56 @@ class KernelInterface(object):
         intended to be used in hardware sanity-checks.
         """
 
-        # This for loop compares the bytes of the target and hash in reverse
-        # order, because both are 256-bit little endian.
-        for t,h in zip(target[::-1], hash[::-1]):
-            if ord(t) > ord(h):
-                return True
-            elif ord(t) < ord(h):
-                return False
-        return True
+        # Both are 256-bit little endian.
+        return (int(hash[::-1].encode('hex'), 16) <=
+                int(target[::-1].encode('hex'), 16))
+
+    def classifyHash(self, wu, hash):
+        """Classifies a hash from a WorkUnit as one of the RESULT_* constants,
+        using the integer targets that the unit has already worked out.
+        """
+
+        value = int(hash[::-1].encode('hex'), 16)
+        if value <= wu.blockTarget:
+            return RESULT_BLOCK
+        elif value <= wu.targetValue:
+            return RESULT_SHARE
+        elif value < DIFF1_LIMIT:
+            return RESULT_DIFF1
+        else:
+            return RESULT_HWERROR
+
+    def getHeaderTemplate(self, wu):
+        """Returns the prepared header of a WorkUnit as a tuple: a sha256
+        object that has already been fed the constant first 64 bytes of the
+        header (in hashing byte order), followed by the header words that
+        come right before and right after the timestamp.
+        The template is built the first time it's needed and kept on the unit.
+        """
+
+        try:
+            return wu.precalculated['header']
+        except KeyError:
+            pass
+
+        staticData = pack('<' + 'I'*19, *unpack('>' + 'I'*19, wu.data[:76]))
+        template = (sha256(staticData[:64]), staticData[64:68],
+                    staticData[72:76])
+        wu.precalculated['header'] = template
+        return template
+
+    def _resolveUnit(self, wu, timestamp):
+        """Kernels can give either a NonceRange or a WorkUnit. Returns the
+        WorkUnit and timestamp to use: if no timestamp is given, that's the
+        one the NonceRange was rolled to, or the WorkUnit's own.
+        """
+        if isinstance(wu, NonceRange):
+            if timestamp is None:
+                timestamp = wu.timestamp
+            wu = wu.unit
+        elif timestamp is None:
+            timestamp = wu.timestamp
+        return wu, timestamp
 
     def calculateHash(self, wu, nonce, timestamp = None):
         """Given a NonceRange/WorkUnit and a nonce, calculate the SHA-256
@@ -177,27 +288,98 @@ class KernelInterface(object):
         integer.
         """
 
-        #If timestamp is not specified then use the one in the WorkUnit
-        if timestamp is None:
-            timestamp = wu.timestamp
+        wu, timestamp = self._resolveUnit(wu, timestamp)
+
+        prefix, before, after = self.getHeaderTemplate(wu)
+        hasher = prefix.copy()
+        hasher.update(before + pack('<I', timestamp) + after +
+                      pack('>I', nonce))
+        return sha256(hasher.digest()).digest()
+
+    def calculateHashes(self, wu, nonces, timestamp = None):
+        """The batch version of calculateHash, for nonces from the same
+        WorkUnit. Big batches are hashed all at once with NumPy.
+        """
+
+        wu, timestamp = self._resolveUnit(wu, timestamp)
 
-        staticDataUnpacked = list(unpack('>' + 'I'*19, wu.data[:76]))
-        staticDataUnpacked[-2] = timestamp
-        staticData = pack('<' + 'I'*19, *staticDataUnpacked)
-        hashInput = pack('>76sI', staticData, nonce)
-        return sha256(sha256(hashInput).digest()).digest()
+        if np is not None and len(nonces) >= VECTOR_MIN:
+            words = hashNonces(wu.midstate, wu.getData(timestamp)[64:76],
+                               np.array(nonces, dtype=np.uint32))
+            digests = np.column_stack(words).astype('>u4').tostring()
+            return [digests[i:i+32] for i in xrange(0, len(digests), 32)]
+
+        prefix, before, after = self.getHeaderTemplate(wu)
+        before += pack('<I', timestamp) + after
+
+        hashes = []
+        for nonce in nonces:
+            hasher = prefix.copy()
+            hasher.update(before + pack('>I', nonce))
+            hashes.append(sha256(hasher.digest()).digest())
+        return hashes
+
+    def verifyNonces(self, wu, nonces, timestamp = None):
+        """Hash a whole batch of nonces from the same WorkUnit, returning a
+        tuple of two lists: the hashes, and whether each hash meets the
+        target of the unit.
+        """
+
+        wu, timestamp = self._resolveUnit(wu, timestamp)
+
+        hashes = self.calculateHashes(wu, nonces, timestamp)
+        passed = [self.classifyHash(wu, hash) >= RESULT_SHARE
+                  for hash in hashes]
+        return hashes, passed
 
     def foundNonce(self, wu, nonce, timestamp = None):
-        """Called by kernels when they may have found a nonce."""
+        """Called by kernels when they may have found a nonce, in a
+        NonceRange (or a WorkUnit, along with the timestamp it was hashed with).
+        """
 
         self.results += 1
 
-        #If timestamp is not specified then use the one in the WorkUnit
-        if timestamp is None:
-            timestamp = wu.timestamp
+        wu, timestamp = self._resolveUnit(wu, timestamp)
 
         # Check if the hash meets the full difficulty before sending.
         hash = self.calculateHash(wu, nonce, timestamp)
+        result = self.classifyHash(wu, hash)
+
+        return self._submitResult(wu, nonce, timestamp, hash, result)
+
+    def foundNonces(self, wu, nonces, timestamp = None):
+        """Called by kernels with a batch of nonces from the same WorkUnit
+        that may be valid. Unlike foundNonce, this is safe to call from any
+        thread: the nonces are hashed and classified in the core's
+        verification thread pool, and only the results go to the main thread.
+        """
+
+        wu, timestamp = self._resolveUnit(wu, timestamp)
+
+        self.core.verifyPool.callInThread(self._verifyNonces, wu,
+                                          [int(n) for n in nonces], timestamp)
+
+    def _verifyNonces(self, wu, nonces, timestamp):
+        # This runs in the verification thread pool.
+        hashes = self.calculateHashes(wu, nonces, timestamp)
+        results = [(nonce, hash, self.classifyHash(wu, hash))
+                   for nonce, hash in zip(nonces, hashes)]
+        reactor.callFromThread(self._submitResults, wu, timestamp, results)
+
+    def _submitResults(self, wu, timestamp, results):
+        for nonce, hash, result in results:
+            self.results += 1
+            self._submitResult(wu, nonce, timestamp, hash, result)
+
+    def _submitResult(self, wu, nonce, timestamp, hash, result):
+        """Deal with a classified result: count it, and send it to the server
+        if it's a share. Returns whether it was sent.
+        """
+
+        if result == RESULT_HWERROR:
+            self.hwerrors += 1
+            self.error('Device returned hash with difficulty < 1')
+            return False
 
         # Check if the block has changed while this NonceRange was being
         # processed by the kernel. If so, don't send it to the server.
@@ -205,7 +387,9 @@ class KernelInterface(object):
                                       'submitold', False):
             return False
 
-        if self.checkTarget(hash, wu.target):
+        if result >= RESULT_SHARE:
+            if result == RESULT_BLOCK:
+                self.blocks += 1
             formattedResult = pack('>68sI4s', wu.data[:68], timestamp,
                                     wu.data[72:76]) + pack('<I', nonce)
             d = self.core.connection.sendResult(formattedResult)
@@ -240,21 +424,22 @@ class KernelInterface(object):
         """Log information as debug so that it can be viewed only when -v is
         enabled.
         """
-        self.core.logger.dispatch(DebugLog(msg, self))
+        self._callInCore(self.core.logger.dispatch, DebugLog(msg, self))
 
     def log(self, msg):
         """Log some general kernel information to the console."""
-        self.core.logger.dispatch(PhoenixLog(msg, self))
+        self._callInCore(self.core.logger.dispatch, PhoenixLog(msg, self))
 
     def error(self, msg=None):
         """The kernel has an issue that requires user attention."""
-        self.core.logger.dispatch(KernelErrorLog(self, msg))
+        self._callInCore(self.core.logger.dispatch,
+                         KernelErrorLog(self, msg))
 
     def fatal(self, msg=None):
         """The kernel has an issue that is preventing it from continuing to
         operate.
         """
-        self.core.logger.dispatch(KernelFatalLog(self, msg))
         self._fatal = True
-
-        self.core.stopKernel(self.deviceID)
+        self._callInCore(self.core.logger.dispatch,
+                         KernelFatalLog(self, msg))
+        self._callInCore(self.core.stopKernel, self.deviceID)
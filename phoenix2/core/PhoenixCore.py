@@ -23,10 +23,12 @@ import sys
 import imp
 import os
 import platform
+import struct
 import time
 from weakref import WeakKeyDictionary
 
-from twisted.internet import reactor, task, defer
+from twisted.internet import reactor, task, defer, threads
+from twisted.python.threadpool import ThreadPool
 
 from .. import backend
 from ..backend.MMPProtocol import MMPClient
@@ -52,6 +54,9 @@ class PhoenixCore(object):
         self.connected = False
         self.connectionType = 'none'
         self.failbackLoop = None
+        self.rateLoop = None
+        self.snapshotLoop = None
+        self.snapshotFile = None
 
         if not hasattr(sys, 'frozen'):
             self.basedir = os.path.dirname(os.path.dirname(__file__))
@@ -61,6 +66,19 @@ class PhoenixCore(object):
         self.config = PhoenixConfig(cfgFilename)
         self.logger = PhoenixLogger(self)
         self.queue = WorkQueue(self)
+
+        # Results from the kernels are checked in these threads, so that a
+        # burst of them doesn't hold up the reactor.
+        self.verifyPool = ThreadPool(
+            1, max(1, self.config.get('general', 'verifythreads', int, 2)),
+            'verify')
+
+        # Kernels are constructed (which, for OpenCL, includes compiling) in
+        # these threads, so that several devices can get ready at once while
+        # the reactor keeps going.
+        self.initPool = ThreadPool(
+            1, max(1, self.config.get('general', 'initthreads', int, 4)),
+            'init')
         self.rpc = PhoenixRPC(self)
 
         self.pluginModules = {}
@@ -69,6 +87,7 @@ class PhoenixCore(object):
         self.plugins = {}
 
         self.kernels = {}
+        self.pendingKernels = set()
         self.interfaces = WeakKeyDictionary()
         self.deviceIDs = []
         self.deviceAutoconfig = {}
@@ -76,6 +95,8 @@ class PhoenixCore(object):
         self.idle = True
         self.lastMetaRate = 0
         self.lastRate = 0
+        self.runningRate = 0 # Kept up to date by the KernelInterfaces.
+        self.rateSamples = self.config.get('general', 'ratesamples', int, 10)
 
         self.startTime = time.time()
 
@@ -87,6 +108,15 @@ class PhoenixCore(object):
         self.logger.log('Welcome to Phoenix ' + self.VERSION)
         self.startTime = time.time()
 
+        self.verifyPool.start()
+        self.initPool.start()
+
+        # Put the work from the last run back in the queue before any kernels
+        # start, so they can get to work before the backend gives us any.
+        self.snapshotFile = self.config.get('general', 'snapshot', str, None)
+        if self.snapshotFile:
+            self.loadSnapshot()
+
         self.discoverPlugins()
         self.startAllKernels()
         self.startAutodetect()
@@ -96,18 +126,72 @@ class PhoenixCore(object):
         self.configChanged()
         self.switchURL(self.config.get('general', 'backend', str))
 
+        # The total rate is published periodically rather than every time a
+        # kernel reports a new rate.
+        self.rateLoop = task.LoopingCall(self._recalculateTotalRate)
+        self.rateLoop.start(self.config.get('general', 'statusinterval',
+                                            float, 1.0), now=False)
+
+        snapshotInterval = self.config.get('general', 'snapshotinterval',
+                                           float, 60)
+        if self.snapshotFile and snapshotInterval > 0:
+            self.snapshotLoop = task.LoopingCall(self.saveSnapshot)
+            self.snapshotLoop.start(snapshotInterval, now=False)
+
         reactor.addSystemEventTrigger('before', 'shutdown', self._shutdown)
 
     def configChanged(self):
         self.rpc.start() # In case the ip/port changed...
+        self.rateSamples = self.config.get('general', 'ratesamples', int, 10)
 
     def _shutdown(self):
+        if self.rateLoop:
+            self.rateLoop.stop()
+            self.rateLoop = None
+        if self.snapshotLoop:
+            self.snapshotLoop.stop()
+            self.snapshotLoop = None
+        if self.snapshotFile:
+            self.saveSnapshot()
         self.stopAutodetect()
         self.switchURL(None)
         for kernel in self.kernels.values():
             if kernel is not None:
                 kernel.stop()
         self.kernels = {}
+        self.pendingKernels.clear()
+        self.initPool.stop()
+        self.verifyPool.stop()
+
+    def loadSnapshot(self):
+        if not os.path.isfile(self.snapshotFile):
+            return
+
+        started = time.time()
+        try:
+            # The snapshot is loaded before connecting, which will be to the
+            # configured backend.
+            restored = self.queue.loadSnapshot(
+                self.snapshotFile, self.config.get('general', 'backend', str))
+        except (IOError, OSError, ValueError, struct.error):
+            self.logger.log('Failed to load queue snapshot "%s"' %
+                            self.snapshotFile)
+            return
+
+        if restored is None:
+            self.logger.log('Queue snapshot "%s" is from another backend, not '
+                            'restoring it' % self.snapshotFile)
+            return
+
+        self.logger.log('Restored %d work units from snapshot in %.1f ms' %
+                        (restored, (time.time() - started) * 1000))
+
+    def saveSnapshot(self):
+        try:
+            self.queue.saveSnapshot(self.snapshotFile, self.connectionURL)
+        except (IOError, OSError):
+            self.logger.log('Failed to save queue snapshot "%s"' %
+                            self.snapshotFile)
 
     def loadPlugin(self, name, silent=False):
         if name in self.pluginModules:
@@ -176,6 +260,11 @@ class PhoenixCore(object):
                     del self.kernels[devid] # Totally forget about it.
                     self.deviceIDs.remove(devidset)
 
+            # Kernels that are still initializing aren't in deviceIDs yet.
+            for devid in list(self.pendingKernels):
+                if not self.checkRules(self._analyzeDevice(devid)[3]):
+                    self.stopKernel(devid)
+
         self.startAutodetect()
 
     def checkRules(self, ids):
@@ -202,13 +291,19 @@ class PhoenixCore(object):
         kernel, ranking, autoconfiguration, ids = self._analyzeDevice(device)
 
         if self.checkRules(ids):
-            if self.startKernel(ids[0]):
+            def started(kernelObject):
+                if kernelObject is None:
+                    return
                 name = autoconfiguration.get('name', device)
                 kernelName = [x for x,y in self.kernelTypes.items() if y ==
                               kernel][0]
                 self.logger.debug('Detected [%s]: [%s] using %s (rating %s)' %
                                   (device, name, kernelName, ranking))
 
+            d = self.startKernel(ids[0])
+            if d is not None:
+                d.addCallback(started)
+
     def _analyzeDevice(self, device):
         if device in self._analysisMemo:
             return self._analysisMemo[device]
@@ -319,7 +414,10 @@ class PhoenixCore(object):
         """Start a brand-new kernel on 'device', passing an optional
         dictionary of kernel parameters.
 
-        The newly-created kernel is returned.
+        The kernel is constructed in one of the init threads, so this returns
+        a Deferred that fires with the newly-created kernel once it has
+        started (or None if it failed to), or None if no kernel is being
+        started at all.
         """
 
         device = device.lower()
@@ -334,6 +432,9 @@ class PhoenixCore(object):
                 if devid in idset:
                     if self.kernels.get(idset[0]) is not None:
                         return
+        for devid in ids:
+            if devid in self.pendingKernels:
+                return
 
         kernelOption = self.config.get(device, 'kernel', str, None)
         if kernelOption:
@@ -353,13 +454,49 @@ class PhoenixCore(object):
         self.deviceAutoconfig[device] = autoconfiguration
 
         interface = KernelInterface(device, self, self.getKernelConfig(device))
+        self.pendingKernels.add(device)
+
+        d = threads.deferToThreadPool(reactor, self.initPool,
+                                      self._initKernel, kernelType, interface)
+        d.addCallbacks(self._kernelReady, self._kernelFailed,
+                       (device, interface, ids),
+                       errbackArgs=(device, interface))
+        return d
+
+    @staticmethod
+    def _initKernel(kernelType, interface):
+        # This runs in the init thread pool.
+        started = time.time()
         kernel = kernelType(interface)
+        return kernel, time.time() - started
+
+    def _kernelFailed(self, failure, device, interface):
+        self.pendingKernels.discard(device)
+        try:
+            failure.raiseException()
+        except Exception:
+            interface.debugException()
+        interface.fatal('Failed to initialize kernel!')
+
+    def _kernelReady(self, result, device, interface, ids):
+        """Called in the main thread when a kernel has been constructed, to
+        finish starting it up.
+        """
+        kernel, elapsed = result
         interface.kernel = kernel
 
+        if device not in self.pendingKernels:
+            # The kernel was stopped (or Phoenix is shutting down) while it
+            # was being initialized.
+            return None
+        self.pendingKernels.discard(device)
+
         if interface._fatal:
             # The kernel had a fatal error in initialization...
             return None
 
+        interface.log('Initialized in %.2f seconds' % elapsed)
+
         self.kernels[device] = kernel
         self.interfaces[kernel] = interface
 
@@ -378,12 +515,21 @@ class PhoenixCore(object):
 
     def stopKernel(self, device):
         """Stop an already-running kernel."""
+        # A kernel that is still initializing is just never started.
+        self.pendingKernels.discard(device)
+
         if device not in self.kernels or self.kernels[device] is None:
             return
 
-        self.kernels[device].stop()
+        kernel = self.kernels[device]
+        kernel.stop()
         self.kernels[device] = None
 
+        # Take the kernel's rate out of the total for good.
+        interface = self.interfaces[kernel]
+        interface._stopped = True
+        self.runningRate -= interface.getRate()
+
         self._recalculateTotalRate()
 
     def setMeta(self, var, value):
@@ -396,13 +542,12 @@ class PhoenixCore(object):
             self.connection.requestWork()
 
     def _recalculateTotalRate(self):
-        # Query all mining cores for their Khash/sec rate and sum.
+        # Publish the Khash/sec rate of all mining cores, which the kernel
+        # interfaces keep summed in runningRate.
 
         self.lastRate = 0
         if not self.idle:
-            for kernel in self.kernels.values():
-                if kernel is not None:
-                    self.lastRate += self.interfaces[kernel].getRate()
+            self.lastRate = self.runningRate
 
         self.logger.dispatch(RateUpdateLog(self.lastRate))
 
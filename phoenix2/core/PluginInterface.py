@@ -21,7 +21,7 @@
 
 import time
 
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
 
 def norpc(func):
     """This is a quick decorator to mark a function as FORBIDDEN to the RPC
@@ -46,7 +46,8 @@ class PluginInterface(object):
                                'connected': self.core.connected,
                                'url': self.core.connectionURL},
                 'results': {'accepted': self.core.logger.accepted,
-                            'rejected': self.core.logger.rejected}}
+                            'rejected': self.core.logger.rejected},
+                'queue': self.core.queue.getStats()}
 
     def getrawconfig(self):
         return self.core.config.text
@@ -79,6 +80,15 @@ class PluginInterface(object):
         self.core.config.save()
         self.core.configChanged()
 
+    def getqueuetarget(self):
+        return self.core.queue.queueTarget
+
+    def setqueuetarget(self, seconds):
+        seconds = self.core.queue.setQueueTarget(float(seconds))
+        self.core.config.set('general', 'queuetarget', seconds)
+        self.core.config.save()
+        return seconds
+
     def redetect(self, terminate=False):
         self.core.redetect(terminate)
 
@@ -117,6 +127,9 @@ class PluginInterface(object):
                 device['results'] = interface.results
                 device['accepted'] = interface.accepted
                 device['rejected'] = interface.rejected
+                device['hwerrors'] = interface.hwerrors
+                device['blocks'] = interface.blocks
+                device['stats'] = interface.stats
             else:
                 disabled = self.core.config.get(miner, 'disabled', bool, False)
 
@@ -131,6 +144,9 @@ class PluginInterface(object):
                 device['results'] = 0
                 device['accepted'] = 0
                 device['rejected'] = 0
+                device['hwerrors'] = 0
+                device['blocks'] = 0
+                device['stats'] = {}
 
             devices.append(device)
 
@@ -162,6 +178,7 @@ class PluginInterface(object):
 
         saveConfig = False
         managed = False
+        starting = [] # Deferreds of kernels that are initializing.
         for miner in self._getminers():
             running = self.core.kernels.get(miner) is not None
             disabled = self.core.config.get(miner, 'disabled', bool, False)
@@ -186,12 +203,20 @@ class PluginInterface(object):
                 elif action == 'start':
                     if disabled:
                         continue # Can't use start(null) for disabled.
-                    if self.core.startKernel(miner):
-                        managed = True
+                    d = self.core.startKernel(miner)
+                    if d is not None:
+                        starting.append(d)
 
         if saveConfig:
             self.core.config.save()
-        return managed
+        if not starting:
+            return managed
+
+        # Starting only counts once the kernel has actually started.
+        d = defer.gatherResults(starting)
+        d.addCallback(lambda kernels: managed or
+                      any(kernel is not None for kernel in kernels))
+        return d
 
     def restart(self, minerID=None):
         return self._manage(minerID, 'restart')
@@ -208,7 +233,10 @@ class PluginInterface(object):
         else:
             self.core.config.set(minerID, 'disabled', None)
             self.core.config.save()
-            return self.core.startKernel(minerID) is not None
+            d = self.core.startKernel(minerID)
+            if d is None:
+                return False
+            return d.addCallback(lambda kernel: kernel is not None)
 
     def shutdown(self):
         reactor.callLater(0.01, reactor.stop)
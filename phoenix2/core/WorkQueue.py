@@ -19,14 +19,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import os
 import struct
+import heapq
 
 from collections import deque
+from itertools import count
 from time import time
 from twisted.internet import defer
-from twisted.internet import reactor
+from twisted.internet import task
 from twisted.internet.defer import DeferredLock
-from ..util.Midstate import calculateMidstate
+from weakref import WeakKeyDictionary
+from ..util.Midstate import cachedMidstate
+from ..backend.ClientBase import AssignedWork
 
 """A WorkUnit is a single unit containing up to 2^32 nonces. A single getWork
 request returns a WorkUnit.
@@ -43,11 +48,23 @@ class WorkUnit(object):
         except AttributeError:
             self.nonces = aw.nonces
         self.base = 0
-        self.midstate = calculateMidstate(self.data[:64])
+        self.midstate = cachedMidstate(self.data[:64])
+        self.targetValue = int(self.target[::-1].encode('hex'), 16)
+        self.blockTarget = self.getBlockTarget()
         self.isStale = False
+        self.staleAt = None
         self.time = aw.time
         self.downloaded = time()
         self.callbacks = set()
+        # Data derived from this unit (by kernels and the KernelInterface) is
+        # kept here, so that it is only calculated once no matter how many
+        # ranges are taken from the unit.
+        self.precalculated = {}
+        # Rolling ntime doesn't create new WorkUnits. Instead, the unit keeps
+        # the timestamp that its nonces are currently being handed out with,
+        # from its own timestamp up to maxtime, and every NonceRange is
+        # tagged with the timestamp it was taken at.
+        self.ntime = self.timestamp
 
     def set_timestamp(self, timestamp):
         self.data = (self.data[:68] + struct.pack('>I', timestamp) +
@@ -56,6 +73,24 @@ class WorkUnit(object):
         return struct.unpack('>I', self.data[68:72])[0]
     timestamp = property(get_timestamp, set_timestamp)
 
+    def getData(self, timestamp=None):
+        """Returns the data of this unit, rolled to the given timestamp."""
+        if timestamp is None or timestamp == self.timestamp:
+            return self.data
+        return self.data[:68] + struct.pack('>I', timestamp) + self.data[72:]
+
+    def getBlockTarget(self):
+        """Expands the compact nBits field of the header into the full
+        target that a hash must meet to solve the block.
+        """
+        bits = struct.unpack('>I', self.data[72:76])[0]
+        exponent = bits >> 24
+        mantissa = bits & 0x7FFFFF
+        if exponent >= 3:
+            return mantissa << (8 * (exponent - 3))
+        else:
+            return mantissa >> (8 * (3 - exponent))
+
     def addStaleCallback(self, callback):
         if self.isStale:
             callback(self)
@@ -68,6 +103,7 @@ class WorkUnit(object):
     def stale(self):
         if self.isStale:
             return
+        self.staleAt = time()
         self.isStale = True
         for cb in list(self.callbacks):
             cb(self)
@@ -77,35 +113,299 @@ single execution of a mining kernel. The size of the NonceRange can be
 adjusted to tune the performance of the kernel.
 
 This class doesn't actually do anything, it's just a well-defined container
-that kernels can pull information out of.
+that kernels can pull information out of. Kernels must hash the nonces with
+the timestamp of the NonceRange (unit.getData(timestamp) has the header for
+it): rolling ntime hands out the same nonces of a WorkUnit again, with a later
+timestamp.
 """
 class NonceRange(object):
 
-    def __init__(self, unit, base, size):
+    def __init__(self, unit, base, size, timestamp=None):
         self.unit = unit # The WorkUnit this NonceRange comes from.
         self.base = base # The base nonce.
         self.size = size # How many nonces this NonceRange says to test.
+        # The (possibly rolled) timestamp to test the nonces with.
+        if timestamp is None:
+            timestamp = unit.ntime
+        self.timestamp = timestamp
 
 class WorkQueue(object):
     """A WorkQueue contains WorkUnits and dispatches NonceRanges when requested
     by the miner. WorkQueues dispatch deffereds when they runs out of nonces.
     """
 
+    # Seconds between checks for expired work.
+    EXPIRY_TICK = 1
+
+    # Bounds on how many seconds of work the adaptive queue tries to hold.
+    QUEUETARGET_MIN = 1
+    QUEUETARGET_MAX = 120
+
+    # Weight of the newest sample in the consumption rate estimate.
+    CONSUMPTION_WEIGHT = 0.25
+
+    # Ranges for requesters that don't ask for a size are sized to take about
+    # rangeTime seconds at the requester's hashrate, rounded down to a power
+    # of two within these limits. Until the rate is known, DEFAULTRANGE is
+    # used.
+    MINRANGE = 1 << 12
+    MAXRANGE = 1 << 32
+    DEFAULTRANGE = 0x10000
+
+    # A queue snapshot is a header of (magic, version, unit count, backend URL
+    # length) and the URL of the backend the work came from, followed by a
+    # record for each WorkUnit: (data, target, maxtime, ntime, time,
+    # downloaded, nonce base, mask, identifier length) and the identifier.
+    SNAPSHOT_MAGIC = 'PHXQ'
+    SNAPSHOT_VERSION = 2
+    SNAPSHOT_HEADER = struct.Struct('<4sHHH')
+    SNAPSHOT_UNIT = struct.Struct('<80s32sIIIdQBH')
+
     def __init__(self, core):
 
         self.core = core
         self.logger = core.logger
         self.queueSize = core.config.get('general', 'queuesize', int, 1)
         self.queueDelay = core.config.get('general', 'queuedelay', int, 5)
+        self.leaseRanges = core.config.get('general', 'leaseranges', int, 16)
+        self.rangeTime = core.config.get('general', 'rangetime', float, 0.5)
+
+        # In adaptive mode, the queue is kept deep enough to last queueTarget
+        # seconds at the rate that nonces are being consumed, so queueSize
+        # is no longer the limit.
+        self.adaptive = core.config.get('general', 'adaptivequeue', bool,
+                                        False)
+        self.setQueueTarget(core.config.get('general', 'queuetarget', float,
+                                            10))
 
         self.lock = DeferredLock()
-        self.queue = deque('', self.queueSize)
+        self.queue = deque('', None if self.adaptive else self.queueSize)
         self.deferredQueue = deque()
         self.currentUnit = None
         self.lastBlock = None
         self.block = ''
 
-        self.staleCallbacks = []
+        # The live WorkUnits of each block, keyed by the block's identifier,
+        # so that a new block only has to stale the units that are still
+        # around. Units leave their group when they expire.
+        self.blockUnits = {}
+
+        # Instead of a reactor timer per WorkUnit, all of the expiry events are
+        # kept in a single heap of (deadline, sequence, function, WorkUnit)
+        # which is checked once per EXPIRY_TICK.
+        self.expiry = []
+        self.expirySequence = count()
+        self.expiryLoop = task.LoopingCall(self._expiryTick)
+        self.expired = 0
+
+        # Each requester (normally a KernelInterface) leases a slice of the
+        # current unit big enough for leaseRanges of its ranges, and takes its
+        # ranges from that without going through the lock.
+        self.leases = WeakKeyDictionary()
+        self.contention = 0
+
+        # Only one lease is renewed at a time for each requester. Any requests
+        # that come in meanwhile wait here as (Deferred, size), and are served
+        # from the new lease.
+        self.renewals = WeakKeyDictionary()
+        self.waitTime = 0
+
+        # Nonces handed out since the last sample, and the estimated rate (in
+        # nonces per second) that the miner consumes them at.
+        self.dispensed = 0
+        self.lastSample = time()
+        self.consumption = 0
+
+    def setQueueTarget(self, seconds):
+        """Set how many seconds of work the adaptive queue should hold,
+        within QUEUETARGET_MIN and QUEUETARGET_MAX. Returns the new target.
+        """
+        self.queueTarget = max(self.QUEUETARGET_MIN,
+                               min(self.QUEUETARGET_MAX, seconds))
+        return self.queueTarget
+
+    def _scheduleExpiry(self, delay, func, wu=None):
+        """Arrange for func(wu) (or func() if wu is None) to be called after
+        delay seconds, by the next expiry tick after that.
+        """
+        heapq.heappush(self.expiry, (time() + delay,
+                                     next(self.expirySequence), func, wu))
+        if not self.expiryLoop.running:
+            self.expiryLoop.start(self.EXPIRY_TICK, now=False)
+
+    def _expiryTick(self):
+        # Pull out everything that's due first, so that events rescheduled by
+        # this batch wait for the next tick.
+        now = time()
+        due = []
+        while self.expiry and self.expiry[0][0] <= now:
+            due.append(heapq.heappop(self.expiry))
+
+        checked = False
+        for deadline, sequence, func, wu in due:
+            if wu is not None:
+                func(wu)
+            elif not checked:
+                # Several units coming up on expiry only need one check.
+                func()
+                checked = True
+
+        self._sampleConsumption(now)
+        if self.adaptive and not checked and self.checkQueue():
+            self.core.requestWork()
+
+    def _sampleConsumption(self, now):
+        dt = now - self.lastSample
+        if dt <= 0:
+            return
+        rate = self.dispensed / dt
+        if self.consumption:
+            self.consumption += self.CONSUMPTION_WEIGHT * (rate -
+                                                           self.consumption)
+        else:
+            self.consumption = rate
+        self.dispensed = 0
+        self.lastSample = now
+
+    def getStats(self):
+        """Returns a dictionary of statistics about the WorkQueue."""
+        live = 0
+        for deadline, sequence, func, wu in self.expiry:
+            if func == self.workExpire and not wu.isStale:
+                live += 1
+        return {'queued': len(self.queue),
+                'live': live,
+                'expired': self.expired,
+                'leases': len(self.leases),
+                'contention': self.contention,
+                'waittime': round(self.waitTime, 3),
+                'adaptive': self.adaptive,
+                'target': self.queueTarget,
+                'consumption': int(self.consumption)}
+
+    def saveSnapshot(self, filename, url):
+        """Write the current unit and the queue, which came from the backend
+        at url, to a snapshot file. The nonce base of each unit is saved as
+        well; ranges that have already been handed out are below it, so they
+        won't be repeated after a restart.
+        """
+
+        units = list(self.queue)
+        if self.currentUnit is not None:
+            units.insert(0, self.currentUnit)
+        units = [wu for wu in units if not wu.isStale]
+
+        url = self._snapshotURL(url)
+        records = [self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC,
+                                             self.SNAPSHOT_VERSION,
+                                             len(units), len(url)), url]
+        for wu in units:
+            identifier = wu.identifier
+            if isinstance(identifier, unicode):
+                identifier = identifier.encode('utf-8')
+            records.append(self.SNAPSHOT_UNIT.pack(
+                wu.data, wu.target, wu.maxtime, wu.ntime, wu.time,
+                wu.downloaded, wu.base, wu.nonces.bit_length() - 1,
+                len(identifier)))
+            records.append(identifier)
+
+        # Write to a temporary file first so that a crash never leaves a
+        # half-written snapshot behind.
+        temp = filename + '.tmp'
+        f = open(temp, 'wb')
+        try:
+            f.write(''.join(records))
+        finally:
+            f.close()
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp, filename)
+
+        return len(units)
+
+    @staticmethod
+    def _snapshotURL(url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return url or ''
+
+    def loadSnapshot(self, filename, url):
+        """Put the WorkUnits from a snapshot file back in the queue, skipping
+        any that will expire too soon to be worth working on. Returns how
+        many units were restored, or None if the snapshot is of work from a
+        backend other than url (which can't be submitted to this one).
+        """
+
+        f = open(filename, 'rb')
+        try:
+            snapshot = f.read()
+        finally:
+            f.close()
+
+        (magic, version, total,
+         length) = self.SNAPSHOT_HEADER.unpack_from(snapshot)
+        if magic != self.SNAPSHOT_MAGIC or version != self.SNAPSHOT_VERSION:
+            raise ValueError('Not a version %d queue snapshot' %
+                             self.SNAPSHOT_VERSION)
+
+        offset = self.SNAPSHOT_HEADER.size
+        if snapshot[offset:offset+length] != self._snapshotURL(url):
+            return None
+        offset += length
+
+        units = []
+        for i in range(total):
+            (data, target, maxtime, ntime, rolltime, downloaded, base, mask,
+             length) = self.SNAPSHOT_UNIT.unpack_from(snapshot, offset)
+            offset += self.SNAPSHOT_UNIT.size
+            identifier = snapshot[offset:offset+length]
+            offset += length
+
+            remaining = downloaded + max(60, rolltime - 1) - time()
+            if remaining < (2 * self.queueDelay):
+                continue
+
+            aw = AssignedWork()
+            aw.data = data
+            aw.target = target
+            aw.mask = mask
+            aw.setMaxTimeIncrement(rolltime)
+            aw.maxtime = maxtime
+            aw.identifier = identifier
+
+            wu = WorkUnit(aw)
+            wu.ntime = ntime
+            wu.base = base
+            wu.downloaded = downloaded
+            units.append((wu, remaining))
+
+        restored = 0
+        for wu, remaining in units:
+            # Work from a different block than the first unit can't be used.
+            if wu.identifier != units[0][0].identifier:
+                continue
+
+            # The first unit (normally the one that was being worked on)
+            # becomes the current unit again, and the rest go in the queue as
+            # far as it has room.
+            if self.currentUnit is None:
+                self.currentUnit = wu
+            elif (self.queue.maxlen is None or
+                  len(self.queue) < self.queue.maxlen):
+                self.queue.append(wu)
+            else:
+                break
+
+            self.block = wu.identifier
+            self._scheduleExpiry(remaining - self.queueDelay, self.checkWork)
+            self._scheduleExpiry(remaining, self.workExpire, wu)
+            self.blockUnits.setdefault(self.block, set()).add(wu)
+            restored += 1
+
+        if restored:
+            self.core.reportIdle(False)
+
+        return restored
 
     def storeWork(self, aw):
 
@@ -121,9 +421,9 @@ class WorkQueue(object):
 
         #create a WorkUnit
         work = WorkUnit(aw)
-        reactor.callLater(max(60, aw.time - 1) - self.queueDelay,
-                            self.checkWork)
-        reactor.callLater(max(60, aw.time - 1), self.workExpire, work)
+        self._scheduleExpiry(max(60, aw.time - 1) - self.queueDelay,
+                             self.checkWork)
+        self._scheduleExpiry(max(60, aw.time - 1), self.workExpire, work)
 
         #check if there is a new block, if so reset queue
         newBlock = (aw.identifier != self.block)
@@ -147,10 +447,11 @@ class WorkQueue(object):
 
         #if there is a new block notify kernels that their work is now stale
         if newBlock:
-            for callback in self.staleCallbacks:
-                callback()
-            self.staleCallbacks = []
-        self.staleCallbacks.append(work.stale)
+            for block in self.blockUnits.keys():
+                if block != self.block:
+                    for wu in self.blockUnits.pop(block):
+                        wu.stale()
+        self.blockUnits.setdefault(self.block, set()).add(work)
 
         #check if there are deferred WorkUnit requests pending
         #since requests to fetch a WorkUnit can add additional deferreds to
@@ -171,6 +472,13 @@ class WorkQueue(object):
 
     def checkQueue(self, added = False):
 
+        # The adaptive queue asks for more work when what's left won't last
+        # for queueTarget seconds at the current consumption rate. Until that
+        # rate is known, it works like the fixed-size queue.
+        if self.adaptive and self.consumption:
+            needed = self.consumption * self.queueTarget
+            return self.availableNonces() < needed
+
         # This function checks the queue length including the current unit
         size = 1
 
@@ -181,13 +489,13 @@ class WorkQueue(object):
             else:
                 size = 0
                 if added:
-                    rolls = self.queue[0].maxtime - self.queue[0].timestamp
+                    rolls = self.queue[0].maxtime - self.queue[0].ntime
                     # If new work can't be rolled, and queue would be too small
                     if rolls == 0 and (len(self.queue) - 1) < self.queueSize:
                         return True
 
         else:
-            remaining = self.currentUnit.maxtime - self.currentUnit.timestamp
+            remaining = self.currentUnit.maxtime - self.currentUnit.ntime
             # Check if we are about to run out of rolltime on current unit
             if remaining < (self.queueDelay):
                 size = 0
@@ -209,6 +517,36 @@ class WorkQueue(object):
         # Return True/False indicating if more work should be fetched
         return size + queueLength < self.queueSize
 
+    def availableNonces(self):
+        """Estimate how many nonces are left in the current unit and the
+        queue, including what can be had by rolling ntime. The units share
+        the miner, so by the time each unit expires, no more than the miner
+        gets through until then can have been used, from all of them
+        together.
+        """
+
+        now = time()
+        units = list(self.queue)
+        if self.currentUnit is not None:
+            units.append(self.currentUnit)
+
+        # The same deadlines that the units expire at, soonest first.
+        deadlines = []
+        for wu in units:
+            lifetime = wu.downloaded + max(60, wu.time - 1) - now
+            if wu.isStale or lifetime < (2 * self.queueDelay):
+                continue
+            rolls = max(0, wu.maxtime - wu.ntime)
+            nonces = (wu.nonces - wu.base) + (wu.nonces * rolls)
+            deadlines.append((lifetime, nonces))
+        deadlines.sort()
+
+        available = 0
+        for lifetime, nonces in deadlines:
+            available = min(available + nonces, self.consumption * lifetime)
+
+        return available
+
     def workExpire(self, wu):
         # Don't expire WorkUnits if idle and queue empty
         if (self.core.idle) and (len(self.queue) <= 1):
@@ -230,10 +568,21 @@ class WorkQueue(object):
                     self.core.connection.requestWork()
 
             # Flag the WorkUnit as stale
+            if not wu.isStale:
+                self.expired += 1
             wu.stale()
+            self._forgetUnit(wu)
         else:
             # Check back again later if we didn't expire the work
-            reactor.callLater(5, self.workExpire, wu)
+            self._scheduleExpiry(5, self.workExpire, wu)
+
+    def _forgetUnit(self, wu):
+        # Take an expired WorkUnit out of the stale registry.
+        units = self.blockUnits.get(wu.identifier)
+        if units is not None:
+            units.discard(wu)
+            if not units:
+                del self.blockUnits[wu.identifier]
 
     def getRangeFromUnit(self, size):
 
@@ -264,7 +613,7 @@ class WorkQueue(object):
 
     def checkRollTime(self, wu):
     # This function checks if a WorkUnit could be time rolled
-        if wu.maxtime > wu.timestamp and not wu.isStale:
+        if wu.maxtime > wu.ntime and not wu.isStale:
             remaining = (wu.downloaded + wu.time) - time()
             if remaining > (self.queueDelay) or len(self.queue) < 1:
                 # If it has been more than 5 minutes probably better to idle
@@ -279,24 +628,12 @@ class WorkQueue(object):
         if not self.checkRollTime(wu):
             return None
 
-        # Create the new WU
-        newWU = WorkUnit(wu)
-
-        # Increment the timestamp
-        newWU.timestamp += 1
-
-        # Reset the download time to the original WU's
-        newWU.downloaded = wu.downloaded
+        # Move the WU on to the next timestamp and start over on its nonces.
+        # It's still the same unit, so it keeps its stale and expiry handling.
+        wu.ntime += 1
+        wu.base = 0
 
-        # Set a stale callback for this WU
-        self.staleCallbacks.append(newWU.stale)
-
-        # Setup a workExpire callback
-        remaining = max(self.queueDelay, (wu.downloaded + wu.time) - time())
-        reactor.callLater(remaining - 1, self.workExpire, newWU)
-
-        # Return the new WU
-        return newWU
+        return wu
 
     def fetchUnit(self, delayed = False):
         #if there is a unit in queue
@@ -329,9 +666,94 @@ class WorkQueue(object):
             self.deferredQueue.append(df)
             return df
 
-    #make sure that only one fetchRange request runs at a time
-    def fetchRange(self, size=0x10000):
-        return self.lock.run(self._fetchRange, size)
+    def rangeSize(self, requester):
+        """Returns the size of range that will take the requester (normally a
+        KernelInterface) about rangeTime seconds, going by its getRate().
+        """
+        rate = requester.getRate() if requester is not None else 0
+        ideal = int(rate * 1000 * self.rangeTime)
+        if ideal <= 0:
+            return self.DEFAULTRANGE
+
+        size = 1 << (ideal.bit_length() - 1)
+        return max(self.MINRANGE, min(self.MAXRANGE, size))
+
+    def fetchRange(self, size=None, requester=None):
+        """Fetch a NonceRange of up to size nonces. Ranges for a requester
+        come out of its own lease whenever possible. If no size is given, it
+        is chosen to suit the requester's hashrate.
+        """
+
+        if size is None:
+            size = self.rangeSize(requester)
+
+        #make sure size is not too large
+        size = min(size, 0x100000000)
+
+        if requester is None:
+            d = self._lockedFetchRange(size)
+            def callback(nr):
+                self.dispensed += nr.size
+                return nr
+            d.addCallback(callback)
+            return d
+
+        lease = self.leases.get(requester)
+        if lease is not None and lease.size and not lease.unit.isStale:
+            return defer.succeed(self._takeFromLease(lease, size))
+
+        # The lease is used up (or there isn't one yet), so get a new one,
+        # unless that's already happening.
+        d = defer.Deferred()
+        waiters = self.renewals.get(requester)
+        if waiters is not None:
+            waiters.append((d, size))
+        else:
+            self.renewals[requester] = [(d, size)]
+            self._renewLease(requester, size)
+        return d
+
+    def _renewLease(self, requester, size):
+        def callback(lease):
+            self.leases[requester] = lease
+            waiters = self.renewals.pop(requester, [])
+            while waiters and lease.size:
+                d, size = waiters.pop(0)
+                d.callback(self._takeFromLease(lease, size))
+
+            # If the lease didn't go far enough, the rest wait for another.
+            if waiters:
+                if requester in self.renewals:
+                    self.renewals[requester].extend(waiters)
+                else:
+                    self.renewals[requester] = waiters
+                    self._renewLease(requester, waiters[0][1])
+        def errback(failure):
+            for d, size in self.renewals.pop(requester, []):
+                d.errback(failure)
+        d = self._lockedFetchRange(size * self.leaseRanges)
+        d.addCallbacks(callback, errback)
+
+    def _takeFromLease(self, lease, size):
+        nr = NonceRange(lease.unit, lease.base, min(size, lease.size),
+                        lease.timestamp)
+        lease.base += nr.size
+        lease.size -= nr.size
+        self.dispensed += nr.size
+        return nr
+
+    #make sure that only one request for the shared unit runs at a time
+    def _lockedFetchRange(self, size):
+        if self.lock.locked:
+            self.contention += 1
+
+        started = time()
+        d = self.lock.run(self._fetchRange, size)
+        def callback(nr):
+            self.waitTime += time() - started
+            return nr
+        d.addCallback(callback)
+        return d
 
     def _fetchRange(self, size):
 
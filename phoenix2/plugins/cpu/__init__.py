@@ -0,0 +1,202 @@
+# Copyright (C) 2012 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import platform
+import multiprocessing
+import signal
+import time
+
+# NumPy does all of the hashing. Importing it here means the plugin just fails
+# to load on systems that don't have it.
+import numpy
+
+from twisted.internet import reactor
+
+from phoenix2.util.Midstate import searchNonces, trySearchNonces
+from phoenix2.util.QueueReader import QueueReader, WorkSizeTuner
+from phoenix2.core.KernelInterface import *
+
+class PhoenixKernel(object):
+    """A Phoenix Miner-compatible CPU kernel, which hashes whole batches of
+    nonces at once using NumPy.
+    """
+
+    TARGETTIME = KernelOption(
+        'TARGETTIME', float, default=0.25, advanced=True,
+        help='The number of seconds that each batch of nonces should take')
+    PROCESSES = KernelOption(
+        'PROCESSES', int, default=1, advanced=False,
+        help='Number of worker processes to hash with (0 for one per core)')
+
+    # The batch size is kept to a power of two within these limits. The upper
+    # limit keeps the working arrays at a few dozen megabytes.
+    MINSIZE = 1 << 12
+    MAXSIZE = 1 << 18
+
+    # This must be manually set for Git
+    REVISION = 1
+
+    def __init__(self, interface):
+        self.interface = interface
+        self.pool = None
+        self._stop = False
+
+        # Verify that we are working with a CPU DeviceID
+        if not self.interface.getDeviceID().startswith('cpu:'):
+            self.interface.fatal('This kernel is only for CPUs!')
+            return
+
+        # A single process hashes in a dedicated thread, but the GIL would
+        # keep several threads on one core, so more than one process means
+        # using a pool of worker processes instead.
+        self.processes = self.PROCESSES
+        if self.processes <= 0:
+            try:
+                self.processes = multiprocessing.cpu_count()
+            except NotImplementedError:
+                self.processes = 1
+
+        if self.processes == 1:
+            # We need a QueueReader to efficiently provide our dedicated
+            # thread with work. It also tunes the batch size.
+            self.qr = QueueReader(self.interface,
+                                  targetTime=self.TARGETTIME,
+                                  minSize=self.MINSIZE, maxSize=self.MAXSIZE)
+        else:
+            # Each worker gets its own batch size, tuned the same way.
+            self.tuners = [WorkSizeTuner(self.TARGETTIME, self.MINSIZE,
+                                         self.MAXSIZE)
+                           for worker in range(self.processes)]
+
+        self.applyMeta()
+
+    @classmethod
+    def autodetect(cls, callback):
+        # This class method is used when Phoenix loads the kernel to autodetect
+        # the devices that it supports.
+        # See doc/cpu.py for further details.
+
+        callback('cpu:0')
+
+    @classmethod
+    def analyzeDevice(cls, devid):
+        # This class method is for analyzing how well a kernel will support a
+        # specific device to help Phoenix automatically choose kernels.
+        # See doc/cpu.py for further details.
+
+        # Any CPU will work, but this is only intended as a fallback.
+        if devid.startswith('cpu:'):
+            return (1, {'name': 'CPU', 'processes': 0}, [devid])
+        else:
+            return (0, {}, [devid])
+
+    def applyMeta(self):
+        """Apply any kernel-specific metadata."""
+        self.interface.setMeta('kernel', 'cpu r%s' % self.REVISION)
+        self.interface.setMeta('device', platform.processor() or 'CPU')
+        self.interface.setMeta('cores', self.processes)
+
+    def start(self):
+        """Phoenix wants the kernel to start."""
+
+        self._stop = False
+        if self.processes == 1:
+            self.qr.start()
+            reactor.callInThread(self.mineThread)
+        else:
+            # The workers are forked with the reactor's signal handlers,
+            # which would leave them ignoring the SIGTERM that terminate()
+            # sends them.
+            self.pool = multiprocessing.Pool(self.processes, signal.signal,
+                                             (signal.SIGTERM, signal.SIG_DFL))
+            for worker in range(self.processes):
+                self.dispatch(worker)
+
+    def stop(self):
+        """Phoenix wants this kernel to stop. The kernel is not necessarily
+        reusable, so it's safe to clean up as well."""
+
+        self._stop = True
+        if self.processes == 1:
+            self.qr.stop()
+        elif self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def dispatch(self, worker):
+        """Fetch a range for a worker process and send it the description of
+        the work: (midstate, tail data, nonce base, count).
+        """
+
+        if self._stop:
+            return
+
+        def callback(nr):
+            if self._stop:
+                return
+            started = time.time()
+            def finished(result):
+                reactor.callFromThread(self.finished, worker, nr, started,
+                                       *result)
+            data = nr.unit.getData(nr.timestamp)
+            self.pool.apply_async(trySearchNonces,
+                                  (nr.unit.midstate, data[64:76],
+                                   nr.base, nr.size),
+                                  callback=finished)
+        self.interface.fetchRange(self.tuners[worker].size).addCallback(
+            callback)
+
+    def finished(self, worker, nr, started, nonces, error=None):
+        """Called in the main thread when a worker process has gone through
+        a range, or failed to (with the traceback as error).
+        """
+
+        if self._stop:
+            return
+
+        if error is not None:
+            # The range is lost, but the worker can carry on with the next.
+            self.interface.error('Worker process %d failed' % worker)
+            for line in error.rstrip().splitlines():
+                self.interface.debug(line)
+            self.dispatch(worker)
+            return
+
+        dt = time.time() - started
+        if dt > 0:
+            self.interface.updateRate(int(nr.size/dt/1000), worker)
+        self.tuners[worker].add([(nr.size, dt)])
+
+        if nonces:
+            self.interface.foundNonces(nr.unit, nonces, nr.timestamp)
+
+        self.dispatch(worker)
+
+    def mineThread(self):
+        for nr in self.qr:
+            data = nr.unit.getData(nr.timestamp)
+            nonces = searchNonces(nr.unit.midstate, data[64:76],
+                                  nr.base, nr.size)
+
+            # Only nonces of at least difficulty 1 come back; foundNonces
+            # will check them against the real target.
+            if nonces:
+                self.interface.foundNonces(nr.unit, nonces, nr.timestamp)
@@ -22,14 +22,17 @@
 import pyopencl as cl
 import numpy as np
 import os
+import time
+import tempfile
 
+from collections import deque
 from math import log
 from hashlib import md5
 from struct import pack, unpack
 from inspect import getargspec
 from twisted.internet import reactor
 
-from phoenix2.util.Midstate import calculateMidstate
+from phoenix2.util.Midstate import cachedMidstate
 from phoenix2.util.QueueReader import QueueReader
 from phoenix2.core.KernelInterface import *
 from phoenix2.util.BFIPatcher import *
@@ -40,11 +43,6 @@ class KernelData(object):
     """
 
     def __init__(self, nr, rateDivisor, aggression):
-        # Prepare some raw data, converting it into the form that the OpenCL
-        # function expects.
-        data = np.array(
-               unpack('IIII', nr.unit.data[64:]), dtype=np.uint32)
-
         # get the number of iterations from the aggression and size
         self.iterations = int(nr.size / (1 << aggression))
         self.iterations = max(1, self.iterations)
@@ -52,47 +50,78 @@ class KernelData(object):
         #set the size to pass to the kernel based on iterations and vectors
         self.size = (nr.size / rateDivisor) / self.iterations
 
-        #compute bases for each iteration
+        #compute bases for each iteration, both packed for the base argument
+        #and as plain integers for the global offset
         self.base = [None] * self.iterations
+        self.offset = [None] * self.iterations
 
         for i in range(self.iterations):
-            self.base[i] = pack('I', (nr.base/rateDivisor) + (i * self.size))
+            self.offset[i] = (nr.base/rateDivisor) + (i * self.size)
+            self.base[i] = pack('I', self.offset[i])
 
         #set up state and precalculated static data
-        self.state = np.array(
-            unpack('IIIIIIII', nr.unit.midstate), dtype=np.uint32)
-        self.state2 = np.array(unpack('IIIIIIII',
-            calculateMidstate(nr.unit.data[64:80] +
-                '\x00\x00\x00\x80' + '\x00'*40 + '\x80\x02\x00\x00',
-                nr.unit.midstate, 3)), dtype=np.uint32)
-        self.state2 = np.array(
-            list(self.state2)[3:] + list(self.state2)[:3], dtype=np.uint32)
+        self.state, self.state2, self.f = self.precalculate(nr.unit,
+                                                            nr.timestamp)
         self.nr = nr
-        self.f = np.zeros(8, np.uint32)
-        self.calculateF(data)
 
-    def calculateF(self, data):
+    @classmethod
+    def precalculate(cls, unit, timestamp):
+        """Returns the (state, state2, f) kernel arguments for a WorkUnit
+        rolled to a timestamp. These only depend on the unit's data, so they
+        are calculated once and kept on the unit for every KernelData of this
+        flavour to share.
+        """
+        key = (cls, timestamp)
+        try:
+            return unit.precalculated[key]
+        except KeyError:
+            pass
+
+        unitData = unit.getData(timestamp)
+
+        # Prepare some raw data, converting it into the form that the OpenCL
+        # function expects.
+        data = np.array(
+               unpack('IIII', unitData[64:]), dtype=np.uint32)
+
+        state = np.array(
+            unpack('IIIIIIII', unit.midstate), dtype=np.uint32)
+        state2 = np.array(unpack('IIIIIIII',
+            cachedMidstate(unitData[64:80] +
+                '\x00\x00\x00\x80' + '\x00'*40 + '\x80\x02\x00\x00',
+                unit.midstate, 3)), dtype=np.uint32)
+        state2 = np.array(
+            list(state2)[3:] + list(state2)[:3], dtype=np.uint32)
+        f = cls.calculateF(data, state, state2)
+
+        unit.precalculated[key] = (state, state2, f)
+        return state, state2, f
+
+    @staticmethod
+    def calculateF(data, state, state2):
         rotr = lambda x,y: x>>y | x<<(32-y)
-        self.f[0] = np.uint32(data[0] + (rotr(data[1], 7) ^ rotr(data[1], 18) ^
+        f = np.zeros(8, np.uint32)
+        f[0] = np.uint32(data[0] + (rotr(data[1], 7) ^ rotr(data[1], 18) ^
             (data[1] >> 3)))
-        self.f[1] = np.uint32(data[1] + (rotr(data[2], 7) ^ rotr(data[2], 18) ^
+        f[1] = np.uint32(data[1] + (rotr(data[2], 7) ^ rotr(data[2], 18) ^
             (data[2] >> 3)) + 0x01100000)
-        self.f[2] = np.uint32(data[2] + (rotr(self.f[0], 17) ^
-            rotr(self.f[0], 19) ^ (self.f[0] >> 10)))
-        self.f[3] = np.uint32(0x11002000 + (rotr(self.f[1], 17) ^
-            rotr(self.f[1], 19) ^ (self.f[1] >> 10)))
-        self.f[4] = np.uint32(0x00000280 + (rotr(self.f[0], 7) ^
-            rotr(self.f[0], 18) ^ (self.f[0] >> 3)))
-        self.f[5] = np.uint32(self.f[0] + (rotr(self.f[1], 7) ^
-            rotr(self.f[1], 18) ^ (self.f[1] >> 3)))
-        self.f[6] = np.uint32(self.state[4] + (rotr(self.state2[1], 6) ^
-            rotr(self.state2[1], 11) ^ rotr(self.state2[1], 25)) +
-            (self.state2[3] ^ (self.state2[1] & (self.state2[2] ^
-            self.state2[3]))) + 0xe9b5dba5)
-        self.f[7] = np.uint32((rotr(self.state2[5], 2) ^
-            rotr(self.state2[5], 13) ^ rotr(self.state2[5], 22)) +
-            ((self.state2[5] & self.state2[6]) | (self.state2[7] &
-            (self.state2[5] | self.state2[6]))))
+        f[2] = np.uint32(data[2] + (rotr(f[0], 17) ^
+            rotr(f[0], 19) ^ (f[0] >> 10)))
+        f[3] = np.uint32(0x11002000 + (rotr(f[1], 17) ^
+            rotr(f[1], 19) ^ (f[1] >> 10)))
+        f[4] = np.uint32(0x00000280 + (rotr(f[0], 7) ^
+            rotr(f[0], 18) ^ (f[0] >> 3)))
+        f[5] = np.uint32(f[0] + (rotr(f[1], 7) ^
+            rotr(f[1], 18) ^ (f[1] >> 3)))
+        f[6] = np.uint32(state[4] + (rotr(state2[1], 6) ^
+            rotr(state2[1], 11) ^ rotr(state2[1], 25)) +
+            (state2[3] ^ (state2[1] & (state2[2] ^
+            state2[3]))) + 0xe9b5dba5)
+        f[7] = np.uint32((rotr(state2[5], 2) ^
+            rotr(state2[5], 13) ^ rotr(state2[5], 22)) +
+            ((state2[5] & state2[6]) | (state2[7] &
+            (state2[5] | state2[6]))))
+        return f
 
 
 class PhoenixKernel(object):
@@ -120,10 +149,28 @@ class PhoenixKernel(object):
     BFI_INT = KernelOption(
         'BFI_INT', bool, default=False, advanced=True,
         help='Use the BFI_INT instruction for AMD/ATI GPUs.')
+    TARGETTIME = KernelOption(
+        'TARGETTIME', float, default=None, advanced=True,
+        help='Tune the work size so that each execution takes this many '
+        'seconds, instead of following AGGRESSION and FASTLOOP (0 to disable)')
+    RESULTS = KernelOption(
+        'RESULTS', int, default=32, advanced=True,
+        help='Number of found nonces that each execution can hold')
+    PIPELINE = KernelOption(
+        'PIPELINE', int, default=1, advanced=True,
+        help='Number of executions to keep queued on the device at once')
+    PREFETCH = KernelOption(
+        'PREFETCH', int, default=1, advanced=True,
+        help='Number of nonce ranges to keep ready ahead of the GPU')
 
     # This must be manually set for Git
     REVISION = 1
 
+    # Positions of the search kernel's arguments that can change between
+    # launches of the same KernelData.
+    BASE_ARG = 14
+    OUTPUT_ARG = 23
+
     def __init__(self, interface):
 
         # Initialize object attributes and retrieve command-line options...)
@@ -135,6 +182,13 @@ class PhoenixKernel(object):
         self.DeviceID = self.interface.getDeviceID()
         self.defines = ''
         self.loopExponent = 0
+        self.staleAborts = 0
+        self.hostWait = 0
+        self.bytesRead = 0
+        self.launches = 0
+        self.overflows = 0
+        self.boundData = None
+        self.boundOutput = None
 
         # Verify that we are working with an opencl DeviceID
         if not self.DeviceID.startswith('cl:'):
@@ -149,9 +203,19 @@ class PhoenixKernel(object):
         self.size = 1 << self.AGGRESSION
 
         # We need a QueueReader to efficiently provide our dedicated thread
-        # with work.
-        self.qr = QueueReader(self.interface, lambda nr: self.preprocess(nr),
-                              lambda x,y: self.size * 1 << self.loopExponent)
+        # with work. With a TARGETTIME, it also picks the work size, starting
+        # from a single execution of 2^AGGRESSION nonces.
+        if self.TARGETTIME:
+            self.qr = QueueReader(self.interface,
+                                  lambda nr: self.preprocess(nr),
+                                  depth=self.PREFETCH,
+                                  targetTime=self.TARGETTIME,
+                                  minSize=self.size)
+        else:
+            workSize = lambda x,y: self.size * 1 << self.loopExponent
+            self.qr = QueueReader(self.interface,
+                                  lambda nr: self.preprocess(nr), workSize,
+                                  depth=self.PREFETCH)
 
         # Setup device
         self.platform, self.device = self.getDevice(self.DeviceID)
@@ -176,13 +240,25 @@ class PhoenixKernel(object):
             self.interface.fatal("Failed to load OpenCL kernel!")
             return
 
+        # Every access to the program's search attribute makes a new kernel
+        # object, so keep one around to bind arguments to.
+        self.searchKernel = self.kernel.search
+
         # Initialize a command queue to send commands to the device, and a
-        # buffer to collect results in...
+        # buffer to collect results in for each execution that can be queued
+        # at once. Each buffer is a count followed by RESULTS slots. The
+        # buffers are in host-accessible memory and mapped to read them,
+        # rather than copied back. The kernel counts results with an atomic
+        # increment, which reads the count too, so they can't be write-only.
+        self.PIPELINE = max(1, self.PIPELINE)
         self.commandQueue = cl.CommandQueue(self.context)
-        self.output = np.zeros(self.WORKSIZE+1, np.uint32)
-        self.output_buf = cl.Buffer(
-            self.context, cl.mem_flags.WRITE_ONLY | cl.mem_flags.USE_HOST_PTR,
-            hostbuf=self.output)
+        self.output_bufs = []
+        for slot in range(self.PIPELINE):
+            self.output_bufs.append(cl.Buffer(
+                self.context,
+                cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR |
+                cl.mem_flags.COPY_HOST_PTR,
+                hostbuf=np.zeros(self.RESULTS+1, np.uint32)))
 
         self.applyMeta()
 
@@ -313,8 +389,10 @@ class PhoenixKernel(object):
                                      + str(maxWorkSize))
                 self.WORKSIZE = maxWorkSize
 
-        # This definition is required for the kernel to function.
+        # These definitions are required for the kernel to function.
         self.defines += (' -DWORKSIZE=' + str(self.WORKSIZE))
+        self.RESULTS = max(1, self.RESULTS)
+        self.defines += (' -DRESULTS=' + str(self.RESULTS))
 
         # If the user wants to mine with vectors, enable the appropriate code
         # in the kernel source.
@@ -393,10 +471,8 @@ class PhoenixKernel(object):
 
                 #write the kernel binaries to file
                 try:
-                    binaryW = open(fileName, 'wb')
-                    binaryW.write(self.kernel.binaries[0])
-                    binaryW.close()
-                except IOError:
+                    self.writeCache(fileName, self.kernel.binaries[0])
+                except (IOError, OSError):
                     pass # Oh well, maybe the filesystem is readonly.
             else:
                 binaryData = binary.read()
@@ -414,6 +490,32 @@ class PhoenixKernel(object):
         finally:
             if binary: binary.close()
 
+    @staticmethod
+    def writeCache(fileName, binaryData):
+        """Save a compiled kernel to the cache. Identical devices share a
+        cache file and may be loading at the same time, so the binary is
+        written to a temporary file first and then moved into place, so that
+        nothing ever reads a half-written binary.
+        """
+        fd, temp = tempfile.mkstemp('.tmp', os.path.basename(fileName),
+                                    os.path.dirname(fileName))
+        try:
+            binaryW = os.fdopen(fd, 'wb')
+            try:
+                binaryW.write(binaryData)
+            finally:
+                binaryW.close()
+            try:
+                os.rename(temp, fileName)
+            except OSError:
+                # Windows won't replace an existing file, but then another
+                # kernel already cached the same binary.
+                if not os.path.exists(fileName):
+                    raise
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
     def start(self):
         """Phoenix wants the kernel to start."""
 
@@ -444,54 +546,150 @@ class PhoenixKernel(object):
             self.loopExponent = int(max(0, EXP))
 
     def preprocess(self, nr):
-        if self.FASTLOOP:
+        if self.FASTLOOP and not self.TARGETTIME:
             self.updateIterations()
 
         kd = KernelData(nr, self.rateDivisor, self.AGGRESSION)
         return kd
 
-    def postprocess(self, output, nr):
-        # Scans over a single buffer produced as a result of running the
-        # OpenCL kernel on the device. This is done outside of the mining
-        # thread for efficiency reasons.
-
-        # Iterate over only the first WORKSIZE items. Exclude the last item
-        # which is a duplicate of the most recently-found nonce.
-        for i in xrange(self.WORKSIZE):
-            if output[i]:
-                if not self.interface.foundNonce(nr.unit, int(output[i])):
-                    hash = self.interface.calculateHash(
-                                                    nr.unit, int(output[i]))
-                    if not hash.endswith('\x00\x00\x00\x00'):
-                        self.interface.error('Device returned hash with '
-                            'difficulty < 1')
+    def postprocess(self, nonces, nr):
+        # Hands the nonces that the mining thread pulled out of an output
+        # buffer to the KernelInterface. They are hashed and classified in
+        # the core's verification threads, and only the results that are
+        # worth submitting reach the main thread.
+        self.interface.foundNonces(nr.unit, nonces, nr.timestamp)
+
+    def staleAbort(self, latency):
+        """Called in the main thread when the mining thread gives up on
+        stale work, with how long it took to notice.
+        """
+        self.staleAborts += 1
+        self.interface.setStat('staleaborts', self.staleAborts)
+        self.interface.setStat('stalelatency', round(latency, 4))
+
+    def kernelArgs(self, data):
+        """Returns the search kernel's arguments for a KernelData, up to (but
+        not including) the output buffer, with the base of its first
+        iteration.
+        """
+        return (list(data.state) +
+                [data.state2[1], data.state2[2], data.state2[3],
+                 data.state2[5], data.state2[6], data.state2[7]] +
+                [data.base[0]] + list(data.f[0:8]))
+
+    def bindArgs(self, data, output_buf):
+        """Make sure the search kernel's arguments are set for a KernelData
+        and output buffer. OpenCL keeps arguments on the kernel between
+        launches, so the static ones are only set once per KernelData and the
+        output buffer only when the pipeline moves to another one.
+        """
+        if data is not self.boundData:
+            self.searchKernel.set_args(*(self.kernelArgs(data) + [output_buf]))
+            self.boundData = data
+            self.boundOutput = output_buf
+        elif output_buf is not self.boundOutput:
+            self.searchKernel.set_arg(self.OUTPUT_ARG, output_buf)
+            self.boundOutput = output_buf
+
+    def enqueueSearch(self, data, i, output_buf):
+        """Queue up the search kernel for iteration i of a KernelData, with
+        its results going to output_buf.
+        """
+        self.bindArgs(data, output_buf)
+
+        # With a global offset, the kernel works out nonces from its global
+        # IDs alone, so only the offset changes from one launch to the next.
+        if self.GOFFSET:
+            offset = (data.offset[i],)
+        else:
+            offset = None
+            self.searchKernel.set_arg(self.BASE_ARG, data.base[i])
+
+        cl.enqueue_nd_range_kernel(self.commandQueue, self.searchKernel,
+                                   (data.size, ), (self.WORKSIZE, ), offset)
+
+    def mapCount(self, slot):
+        """Queue up a mapping of just the result count at the start of an
+        output buffer. Returns the (mapped array, event).
+        """
+        return cl.enqueue_map_buffer(
+            self.commandQueue, self.output_bufs[slot],
+            cl.map_flags.READ | cl.map_flags.WRITE, 0, (1,), np.uint32,
+            is_blocking=False)
+
+    def checkLaunch(self, event, count, slot, nr):
+        """Wait for a launch to finish and check its output buffer."""
+
+        waitStarted = time.time()
+        event.wait()
+        self.hostWait += time.time() - waitStarted
+
+        # The OpenCL code counts the nonces it finds at the start of the
+        # output buffer. The count is reset for the next pass right away.
+        found = int(count[0])
+        count[0] = 0
+        count.base.release(self.commandQueue)
+        self.bytesRead += count.nbytes
+
+        # If there were any, map just the slots that were filled and pass
+        # the nonces on for postprocessing. Any that didn't fit in the buffer
+        # are lost, but counted.
+        if found:
+            stored = min(found, self.RESULTS)
+            self.overflows += found - stored
+
+            output, event = cl.enqueue_map_buffer(
+                self.commandQueue, self.output_bufs[slot],
+                cl.map_flags.READ, 4, (stored,), np.uint32)
+            nonces = output.copy()
+            output.base.release(self.commandQueue)
+            self.bytesRead += output.nbytes
+
+            self.postprocess(nonces, nr)
 
     def mineThread(self):
+        # Launches that have been queued, but not checked yet, as (map event,
+        # mapped count, output slot, NonceRange). With PIPELINE output
+        # buffers, the next launch is queued before waiting on the oldest
+        # one, so the device always has something to do.
+        inFlight = deque()
+        reported = time.time()
+
         for data in self.qr:
+            unit = data.nr.unit
             for i in range(data.iterations):
-                offset = (unpack('I', data.base[i])[0],) if self.GOFFSET else None
-                self.kernel.search(
-                    self.commandQueue, (data.size, ), (self.WORKSIZE, ),
-                    data.state[0], data.state[1], data.state[2], data.state[3],
-                    data.state[4], data.state[5], data.state[6], data.state[7],
-                    data.state2[1], data.state2[2], data.state2[3],
-                    data.state2[5], data.state2[6], data.state2[7],
-                    data.base[i],
-                    data.f[0], data.f[1], data.f[2], data.f[3],
-                    data.f[4], data.f[5], data.f[6], data.f[7],
-                    self.output_buf, global_offset=offset)
-                cl.enqueue_read_buffer(self.commandQueue, self.output_buf,
-                                       self.output, is_blocking=False)
-                self.commandQueue.finish()
-
-                # The OpenCL code will flag the last item in the output buffer
-                # when it finds a valid nonce. If that's the case, send it to
-                # the main thread for postprocessing and clean the buffer
-                # for the next pass.
-                if self.output[self.WORKSIZE]:
-                    reactor.callFromThread(self.postprocess,
-                    self.output.copy(), data.nr)
-
-                    self.output.fill(0)
-                    cl.enqueue_write_buffer(self.commandQueue, self.output_buf,
-                                            self.output, is_blocking=False)
+                # Don't spend any more launches on work that has gone stale.
+                if unit.isStale:
+                    reactor.callFromThread(self.staleAbort,
+                                           time.time() - unit.staleAt)
+                    self.qr.abort(data.nr.size * i / data.iterations)
+                    break
+
+                slot = self.launches % self.PIPELINE
+                self.launches += 1
+                self.enqueueSearch(data, i, self.output_bufs[slot])
+                count, event = self.mapCount(slot)
+                inFlight.append((event, count, slot, data.nr))
+
+                # Results are always checked in the order they were launched.
+                while len(inFlight) >= self.PIPELINE:
+                    self.checkLaunch(*inFlight.popleft())
+
+            # Don't leave results sitting on the device while waiting for
+            # more work.
+            if self.qr.dataQueue.empty():
+                while inFlight:
+                    self.checkLaunch(*inFlight.popleft())
+
+            if time.time() - reported >= 1:
+                reported = time.time()
+                reactor.callFromThread(self.reportStats,
+                                       round(self.hostWait, 3),
+                                       self.bytesRead, self.launches,
+                                       self.overflows)
+
+    def reportStats(self, hostWait, bytesRead, launches, overflows):
+        self.interface.setStat('hostwaittime', hostWait)
+        self.interface.setStat('bytesread', bytesRead)
+        self.interface.setStat('launches', launches)
+        self.interface.setStat('resultoverflows', overflows)
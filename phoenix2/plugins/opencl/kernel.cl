@@ -47,6 +47,20 @@ __constant uint K[64] = {
 	#define Ma(x, y, z) (((u)x & (u)z) | ((u)y & ((u)x | (u)z)))
 #endif
 
+// Found nonces are appended to the output buffer: output[0] counts the
+// results, and the RESULTS slots after it hold them in the order they were
+// found. The count keeps going once the slots are full, so the host can tell
+// how many results didn't fit.
+#ifdef cl_khr_global_int32_base_atomics
+	#pragma OPENCL EXTENSION cl_khr_global_int32_base_atomics : enable
+#endif
+// atomic_inc is only built in from OpenCL 1.1. Before that, the extension
+// provides it as atom_inc.
+#if !defined(__OPENCL_VERSION__) || __OPENCL_VERSION__ < 110
+	#define atomic_inc atom_inc
+#endif
+#define RESULT(n) { uint slot = atomic_inc(output); if (slot < RESULTS) output[slot + 1] = (n); }
+
 __kernel void search(	const uint state0, const uint state1, const uint state2, const uint state3,
 						const uint state4, const uint state5, const uint state6, const uint state7,
 						const uint B1, const uint C1, const uint D1,
@@ -303,33 +317,33 @@ __kernel void search(	const uint state0, const uint state1, const uint state2, c
 #ifdef VECTORS4
 	if (H.x == 0)
 	{
-		output[WORKSIZE] = output[get_local_id(0)] = nonce.x;
+		RESULT(nonce.x);
 	}
-	else if (H.y == 0)
+	if (H.y == 0)
 	{
-		output[WORKSIZE] = output[get_local_id(0)] = nonce.y;
+		RESULT(nonce.y);
 	}
-	else if (H.z == 0)
+	if (H.z == 0)
 	{
-		output[WORKSIZE] = output[get_local_id(0)] = nonce.z;
+		RESULT(nonce.z);
 	}
-	else if (H.w == 0)
+	if (H.w == 0)
 	{
-		output[WORKSIZE] = output[get_local_id(0)] = nonce.w;
+		RESULT(nonce.w);
 	}
 #elif defined VECTORS
 	if (H.x == 0)
 	{
-		output[WORKSIZE] = output[get_local_id(0)] = nonce.x;
+		RESULT(nonce.x);
 	}
-	else if (H.y == 0)
+	if (H.y == 0)
 	{
-		output[WORKSIZE] = output[get_local_id(0)] = nonce.y;
+		RESULT(nonce.y);
 	}
 #else
 	if (H == 0)
 	{
-		output[WORKSIZE] = output[get_local_id(0)] = nonce;
+		RESULT(nonce);
 	}
 #endif
 }
\ No newline at end of file
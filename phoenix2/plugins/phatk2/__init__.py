@@ -28,9 +28,8 @@ import sys
 from math import log
 from hashlib import md5
 from struct import pack, unpack
-from twisted.internet import reactor
 
-from phoenix2.util.Midstate import calculateMidstate
+from phoenix2.util.Midstate import cachedMidstate
 from phoenix2.util.QueueReader import QueueReader
 from phoenix2.core.KernelInterface import *
 from phoenix2.util.BFIPatcher import *
@@ -44,11 +43,6 @@ class KernelData(object):
     """
 
     def __init__(self, nr, rateDivisor, aggression):
-        # Prepare some raw data, converting it into the form that the OpenCL
-        # function expects.
-        data = np.array(
-               unpack('IIII', nr.unit.data[64:]), dtype=np.uint32)
-
         # get the number of iterations from the aggression and size
         self.iterations = int(nr.size / (1 << aggression))
         self.iterations = max(1, self.iterations)
@@ -74,53 +68,79 @@ class KernelData(object):
                     , (3 + nr.base + (i * self.size * rateDivisor))
                     )
         #set up state and precalculated static data
-        self.state = np.array(
-            unpack('IIIIIIII', nr.unit.midstate), dtype=np.uint32)
-        self.state2 = np.array(unpack('IIIIIIII',
-            calculateMidstate(nr.unit.data[64:80] +
-                '\x00\x00\x00\x80' + '\x00'*40 + '\x80\x02\x00\x00',
-                nr.unit.midstate, 3)), dtype=np.uint32)
-        self.state2 = np.array(
-            list(self.state2)[3:] + list(self.state2)[:3], dtype=np.uint32)
+        self.state, self.state2, self.f = self.precalculate(nr.unit,
+                                                            nr.timestamp)
         self.nr = nr
 
-        self.f = np.zeros(9, np.uint32)
-        self.calculateF(data)
+    @classmethod
+    def precalculate(cls, unit, timestamp):
+        """Returns the (state, state2, f) kernel arguments for a WorkUnit
+        rolled to a timestamp, calculated once and then shared through the
+        unit.
+        """
+        key = (cls, timestamp)
+        try:
+            return unit.precalculated[key]
+        except KeyError:
+            pass
+
+        unitData = unit.getData(timestamp)
+
+        # Prepare some raw data, converting it into the form that the OpenCL
+        # function expects.
+        data = np.array(
+               unpack('IIII', unitData[64:]), dtype=np.uint32)
+
+        state = np.array(
+            unpack('IIIIIIII', unit.midstate), dtype=np.uint32)
+        state2 = np.array(unpack('IIIIIIII',
+            cachedMidstate(unitData[64:80] +
+                '\x00\x00\x00\x80' + '\x00'*40 + '\x80\x02\x00\x00',
+                unit.midstate, 3)), dtype=np.uint32)
+        state2 = np.array(
+            list(state2)[3:] + list(state2)[:3], dtype=np.uint32)
+        f = cls.calculateF(data, state, state2)
+
+        unit.precalculated[key] = (state, state2, f)
+        return state, state2, f
 
-    def calculateF(self, data):
+    @staticmethod
+    def calculateF(data, state, state2):
         rotr = lambda x,y: x>>y | x<<(32-y)
+        f = np.zeros(9, np.uint32)
         #W2
-        self.f[0] = np.uint32(data[2])
+        f[0] = np.uint32(data[2])
 
         #W16
         W16 = np.uint32(data[0] + (rotr(data[1], 7) ^ rotr(data[1], 18) ^
             (data[1] >> 3)))
-        self.f[1] = W16
+        f[1] = W16
         #W17
         W17 = np.uint32(data[1] + (rotr(data[2], 7) ^ rotr(data[2], 18) ^
             (data[2] >> 3)) + 0x01100000)
-        self.f[2] = W17
+        f[2] = W17
 
         #2 parts of the first SHA round
-        PreVal4 = (self.state[4] + (rotr(self.state2[1], 6) ^
-            rotr(self.state2[1], 11) ^ rotr(self.state2[1], 25)) +
-            (self.state2[3] ^ (self.state2[1] & (self.state2[2] ^
-            self.state2[3]))) + 0xe9b5dba5)
-        T1 = ((rotr(self.state2[5], 2) ^
-            rotr(self.state2[5], 13) ^ rotr(self.state2[5], 22)) +
-            ((self.state2[5] & self.state2[6]) | (self.state2[7] &
-            (self.state2[5] | self.state2[6]))))
-        self.f[3] = np.uint32(( PreVal4 + T1))
-        self.f[4] = np.uint32( PreVal4 + self.state[0])
-        self.f[5] = np.uint32(0x00000280 + ((rotr(W16, 7) ^
+        PreVal4 = (state[4] + (rotr(state2[1], 6) ^
+            rotr(state2[1], 11) ^ rotr(state2[1], 25)) +
+            (state2[3] ^ (state2[1] & (state2[2] ^
+            state2[3]))) + 0xe9b5dba5)
+        T1 = ((rotr(state2[5], 2) ^
+            rotr(state2[5], 13) ^ rotr(state2[5], 22)) +
+            ((state2[5] & state2[6]) | (state2[7] &
+            (state2[5] | state2[6]))))
+        f[3] = np.uint32(( PreVal4 + T1))
+        f[4] = np.uint32( PreVal4 + state[0])
+        f[5] = np.uint32(0x00000280 + ((rotr(W16, 7) ^
             rotr(W16, 18) ^ (W16 >> 3))))
-        self.f[6] = np.uint32(self.f[1] + ((rotr(W17, 7) ^
+        f[6] = np.uint32(f[1] + ((rotr(W17, 7) ^
             rotr(W17, 18) ^ (W17 >> 3))))
 
-        self.f[7] = np.uint32(0x11002000 + (rotr(W17, 17) ^ rotr(W17, 19) ^
+        f[7] = np.uint32(0x11002000 + (rotr(W17, 17) ^ rotr(W17, 19) ^
             (W17 >> 10)))
-        self.f[8] = np.uint32(data[2] + (rotr(W16, 17) ^ rotr(W16, 19) ^
+        f[8] = np.uint32(data[2] + (rotr(W16, 17) ^ rotr(W16, 19) ^
             (W16 >> 10)))
+        return f
 
 # phatk2 is implemented by inheriting from opencl and then overriding the
 # nessesary functions. See kernels/opencl to see the rest of the code.
@@ -186,39 +206,29 @@ class PhoenixKernel(opencl.PhoenixKernel):
         self.interface.setMeta('cores', self.device.max_compute_units)
 
     def preprocess(self, nr):
-        if self.FASTLOOP:
+        if self.FASTLOOP and not self.TARGETTIME:
             self.updateIterations()
 
         kd = KernelData(nr, self.rateDivisor, self.AGGRESSION)
         return kd
 
-    def mineThread(self):
-        for data in self.qr:
-            for i in range(data.iterations):
-                self.kernel.search(
-                    self.commandQueue, (data.size, ), (self.WORKSIZE, ),
-                    data.state[0], data.state[1], data.state[2], data.state[3],
-                    data.state[4], data.state[5], data.state[6], data.state[7],
-                    data.state2[1], data.state2[2], data.state2[3],
-                    data.state2[5], data.state2[6], data.state2[7],
-                    data.base[i],
-                    data.f[1],data.f[2],
-                    data.f[3],data.f[4],
-                    data.f[5],data.f[6],
-                    data.f[7],data.f[8],
-                    self.output_buf)
-                cl.enqueue_read_buffer(self.commandQueue, self.output_buf,
-                                       self.output, is_blocking=False)
-                self.commandQueue.finish()
-
-                # The OpenCL code will flag the last item in the output buffer
-                # when it finds a valid nonce. If that's the case, send it to
-                # the main thread for postprocessing and clean the buffer
-                # for the next pass.
-                if self.output[self.WORKSIZE]:
-                    reactor.callFromThread(self.postprocess,
-                    self.output.copy(), data.nr)
-
-                    self.output.fill(0)
-                    cl.enqueue_write_buffer(self.commandQueue, self.output_buf,
-                                            self.output, is_blocking=False)
+    def kernelArgs(self, data):
+        """Returns the search kernel's arguments for a KernelData, up to (but
+        not including) the output buffer, with the base of its first
+        iteration.
+        """
+        return (list(data.state) +
+                [data.state2[1], data.state2[2], data.state2[3],
+                 data.state2[5], data.state2[6], data.state2[7]] +
+                [data.base[0]] + list(data.f[1:9]))
+
+    def enqueueSearch(self, data, i, output_buf):
+        """Queue up the search kernel for iteration i of a KernelData, with
+        its results going to output_buf.
+        """
+        # This kernel doesn't use a global offset, so the base always has to
+        # be updated.
+        self.bindArgs(data, output_buf)
+        self.searchKernel.set_arg(self.BASE_ARG, data.base[i])
+        cl.enqueue_nd_range_kernel(self.commandQueue, self.searchKernel,
+                                   (data.size, ), (self.WORKSIZE, ))
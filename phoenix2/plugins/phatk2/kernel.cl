@@ -126,6 +126,20 @@ __constant uint H[8] = {
 #define Barrier1(n) t1 = t1C((n+1))
 #define Barrier2(n) t1 = t1C((n))
 
+// Found nonces are appended to the output buffer: output[0] counts the
+// results, and the RESULTS slots after it hold them in the order they were
+// found. The count keeps going once the slots are full, so the host can tell
+// how many results didn't fit.
+#ifdef cl_khr_global_int32_base_atomics
+	#pragma OPENCL EXTENSION cl_khr_global_int32_base_atomics : enable
+#endif
+// atomic_inc is only built in from OpenCL 1.1. Before that, the extension
+// provides it as atom_inc.
+#if !defined(__OPENCL_VERSION__) || __OPENCL_VERSION__ < 110
+	#define atomic_inc atom_inc
+#endif
+#define RESULT(n) { uint slot = atomic_inc(output); if (slot < RESULTS) output[slot + 1] = (n); }
+
 __kernel
 //removed this to allow detection of invalid work size
 //__attribute__((reqd_work_group_size(WORKSIZE, 1, 1)))
@@ -352,42 +366,36 @@ void search(	const uint state0, const uint state1, const uint state2, const uint
 	u v = W[117] + W[108] + Vals[3] + Vals[7] + P2(124) + P1(124) + Ch((Vals[0] + Vals[4]) + (K[59] + W(59+64)) + s1(64+59)+ ch(59+64),Vals[1],Vals[2]); 
 	u g = -(K[60] + H[7]) - S1((Vals[0] + Vals[4]) + (K[59] + W(59+64))  + s1(64+59)+ ch(59+64));
 
-	uint nonce = 0;
 #ifdef VECTORS4
 	if (v.x == g.x)
 	{
-		nonce = W[3].x;
+		RESULT(W[3].x);
 	}
 	if (v.y == g.y)
 	{
-		nonce = W[3].y;
+		RESULT(W[3].y);
 	}
 	if (v.z == g.z)
 	{
-		nonce = W[3].z;
+		RESULT(W[3].z);
 	}
 	if (v.w == g.w)
 	{
-		nonce = W[3].w;
+		RESULT(W[3].w);
 	}
 #elif defined VECTORS
 	if (v.x == g.x)
 	{
-		nonce = W[3].x;
+		RESULT(W[3].x);
 	}
 	if (v.y == g.y)
 	{
-		nonce = W[3].y;
+		RESULT(W[3].y);
 	}
 #else
 	if (v == g)
 	{
-		nonce = W[3];
+		RESULT(W[3]);
 	}
 #endif
-	if(nonce)
-	{
-		output[WORKSIZE] = nonce;
-		output[get_local_id(0)] = nonce;
-	}
 }
\ No newline at end of file
@@ -20,6 +20,14 @@
 # THE SOFTWARE.
 
 import struct
+import traceback
+
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None # Only the batch functions need NumPy.
 
 # Some SHA-256 constants...
 K = [
@@ -45,6 +53,10 @@ F0 = 0x9b05688c
 G0 = 0x1f83d9ab
 H0 = 0x5be0cd19
 
+if np is not None:
+    _K = np.array(K, dtype=np.uint32)
+    _IV = np.array([A0, B0, C0, D0, E0, F0, G0, H0], dtype=np.uint32)
+
 def rotateright(i,p):
     """i>>>p"""
     p &= 0x1F # p mod 32
@@ -105,4 +117,158 @@ def calculateMidstate(data, state=None, rounds=None):
         g = addu32(g, G0)
         h = addu32(h, H0)
 
-    return struct.pack('<IIIIIIII', a, b, c, d, e, f, g, h)
\ No newline at end of file
+    return struct.pack('<IIIIIIII', a, b, c, d, e, f, g, h)
+
+def _rotr(x, p):
+    """x>>>p, for NumPy uint32 arrays"""
+    return (x >> p) | (x << (32 - p))
+
+def sha256Rounds(w, state, rounds=64):
+    """Run SHA-256 rounds over NumPy uint32 arrays, so that many messages can
+    be processed at once. w is a sequence of the 16 message words and state is
+    a sequence of the 8 working variables; each item is an array holding that
+    word for every message (they are broadcast together, so shared words may
+    be 1-element arrays). The working variables are returned without the
+    final feed-forward addition.
+    """
+    w = list(w)
+    a,b,c,d,e,f,g,h = state
+
+    for k in _K[:rounds]:
+        s0 = _rotr(a,2) ^ _rotr(a,13) ^ _rotr(a,22)
+        s1 = _rotr(e,6) ^ _rotr(e,11) ^ _rotr(e,25)
+        ma = (a&b) ^ (a&c) ^ (b&c)
+        ch = (e&f) ^ ((~e)&g)
+
+        h = h + w[0] + k + ch + s1
+        d = d + h
+        h = h + ma + s0
+
+        a,b,c,d,e,f,g,h = h,a,b,c,d,e,f,g
+
+        s0 = _rotr(w[1],7) ^ _rotr(w[1],18) ^ (w[1] >> 3)
+        s1 = _rotr(w[14],17) ^ _rotr(w[14],19) ^ (w[14] >> 10)
+        w.append(w[0] + s0 + w[9] + s1)
+        w.pop(0)
+
+    return [a,b,c,d,e,f,g,h]
+
+def calculateMidstates(data, states=None, rounds=None):
+    """The batch version of calculateMidstate. data is an (N,64) uint8 array
+    (or a string of N 64-byte blocks) and states is an optional (N,32) array of
+    input states. All N midstates are calculated at once and returned as an
+    (N,32) uint8 array; each row is bit-identical to what calculateMidstate
+    would return for the same block.
+    """
+    if np is None:
+        raise ImportError('calculateMidstates requires NumPy')
+
+    if isinstance(data, str):
+        data = np.frombuffer(data, np.uint8)
+    data = np.ascontiguousarray(data, dtype=np.uint8)
+    if data.size % 64:
+        raise ValueError('data must consist of 64-byte blocks')
+    data = data.reshape(-1, 64)
+
+    words = data.view('<u4').astype(np.uint32)
+    w = [words[:,i] for i in range(16)]
+
+    if states is not None:
+        if isinstance(states, str):
+            states = np.frombuffer(states, np.uint8)
+        states = np.ascontiguousarray(states, dtype=np.uint8)
+        if states.size != len(data) * 32:
+            raise ValueError('states must be 32 bytes long for each block')
+        states = states.reshape(-1, 32).view('<u4').astype(np.uint32)
+        state = [states[:,i] for i in range(8)]
+    else:
+        state = [np.full(len(data), x, np.uint32) for x in _IV]
+
+    state = sha256Rounds(w, state, 64 if rounds is None else rounds)
+
+    if rounds is None:
+        state = [x + iv for x,iv in zip(state, _IV)]
+
+    return np.column_stack(state).astype('<u4').view(np.uint8)
+
+
+def hashNonces(midstate, data, nonces):
+    """Calculate the SHA-256d hashes of a block header for many nonces at once,
+    starting from the midstate of its first block. data is the 12 bytes of
+    (byteswapped) header that come before the nonce, and nonces is a uint32
+    array. The 8 words of the final hashes are returned as uint32 arrays.
+    """
+    if np is None:
+        raise ImportError('hashNonces requires NumPy')
+
+    one = lambda x: np.array([x], dtype=np.uint32)
+    zero = one(0)
+
+    midstate = [one(x) for x in struct.unpack('<IIIIIIII', midstate)]
+    w = [one(x) for x in struct.unpack('<III', data)]
+    w += [nonces, one(0x80000000)] + [zero]*10 + [one(0x280)]
+    state = sha256Rounds(w, midstate)
+    state = [x + m for x,m in zip(state, midstate)]
+
+    w = state + [one(0x80000000)] + [zero]*6 + [one(0x100)]
+    state = sha256Rounds(w, [one(x) for x in _IV])
+    return [x + iv for x,iv in zip(state, _IV)]
+
+def searchNonces(midstate, data, base, count):
+    """Test count nonces starting at base (see hashNonces for the other
+    arguments) and return the ones that produce a hash of at least
+    difficulty 1, as a list.
+    """
+    nonces = np.arange(count, dtype=np.uint32) + np.uint32(base)
+    h7 = hashNonces(midstate, data, nonces)[7]
+    return [int(x) for x in nonces[h7 == 0]]
+
+def trySearchNonces(midstate, data, base, count):
+    """searchNonces for worker processes, which have no way to report an
+    exception: returns (nonces, None) if it worked, or (None, traceback) if
+    it didn't.
+    """
+    try:
+        return searchNonces(midstate, data, base, count), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+class MidstateCache(object):
+    """A bounded LRU cache in front of calculateMidstate. Rolling the ntime of
+    a WorkUnit only changes the second block of its header, so every rolled
+    unit (and every KernelData built from it) can share the midstate that was
+    calculated for the first one.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def calculate(self, data, state=None, rounds=None):
+        """Same as calculateMidstate, but answered from the cache if this
+        exact calculation has been done recently.
+        """
+        key = (data, state, rounds)
+        try:
+            midstate = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            midstate = calculateMidstate(data, state, rounds)
+            if len(self.entries) >= self.size:
+                self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+
+        # (Re)inserting puts the entry at the most recently used end.
+        self.entries[key] = midstate
+        return midstate
+
+    def clear(self):
+        self.entries.clear()
+
+# The cache shared by the WorkQueue and the kernels.
+midstateCache = MidstateCache()
+cachedMidstate = midstateCache.calculate
@@ -21,8 +21,53 @@
 
 from time import time
 from Queue import Queue, Empty
+from threading import Lock
+from collections import deque
 from twisted.internet import reactor, defer
 
+class WorkSizeTuner(object):
+    """Picks the work size (in nonces) for executions to take about
+    targetTime seconds, going by how fast the last few went. The size is kept
+    to a power of two between minSize and maxSize.
+    """
+
+    SAMPLES = 3
+
+    def __init__(self, targetTime, minSize=1<<16, maxSize=1<<32):
+        self.targetTime = targetTime
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.size = minSize
+
+        # (size, execution time) of the last few executions, and their
+        # average execution time once there are enough of them.
+        self.samples = []
+        self.averageTime = None
+
+    def add(self, executions):
+        """Record a list of (size, execution time) and retune the size."""
+
+        self.samples.extend(executions)
+        self.samples = self.samples[-self.SAMPLES:]
+        if len(self.samples) < self.SAMPLES:
+            return
+
+        size = sum(s for s, dt in self.samples)
+        elapsed = sum(dt for s, dt in self.samples)
+        if elapsed <= 0:
+            return
+
+        # The size only changes once it's off by a factor of two. It then goes
+        # straight to the largest power of two that fits in the targetTime,
+        # which takes between half of and all of the targetTime, so the next
+        # measurements leave it alone.
+        ideal = size * self.targetTime / elapsed
+        if ideal >= self.size * 2 or ideal < self.size / 2.0:
+            size = 1 << max(0, int(ideal).bit_length() - 1)
+            self.size = max(self.minSize, min(self.maxSize, size))
+
+        self.averageTime = elapsed / len(self.samples)
+
 class QueueReader(object):
     """A QueueReader is a very efficient WorkQueue reader that keeps the next
     nonce range available at all times. The benefit is that threaded mining
@@ -31,16 +76,29 @@ class QueueReader(object):
 
     The QueueReader is iterable, so a dedicated mining thread needs only to do
     for ... in self.qr:
+
+    The depth is how many ranges to keep fetched and preprocessed ahead of the
+    mining thread, so that a busy main thread doesn't leave it waiting.
+
+    Kernels can either size their ranges with a workSizeCallback, or give a
+    targetTime to have the QueueReader tune the size so that each execution
+    takes about that many seconds.
     """
 
     SAMPLES = 3
 
     def __init__(self, interface, preprocessor=None, workSizeCallback=None,
-                 index=None):
+                 index=None, depth=1, targetTime=None, minSize=1<<16,
+                 maxSize=1<<32):
         self.interface = interface
         self.preprocessor = preprocessor
         self.workSizeCallback = workSizeCallback
         self.index = index
+        self.depth = max(1, depth)
+        self.targetTime = targetTime
+        self.tuner = None
+        if targetTime:
+            self.tuner = WorkSizeTuner(targetTime, minSize, maxSize)
 
         if self.preprocessor is not None:
             if not callable(self.preprocessor):
@@ -52,19 +110,39 @@ class QueueReader(object):
         # This shuttles work to the dedicated thread.
         self.dataQueue = Queue()
 
+        # Ranges that have been requested, but aren't in the dataQueue yet.
+        self.pending = 0
+        self._stopped = False
+
+        # How many times, and for how many seconds in total, the dedicated
+        # thread had to wait for work.
+        self.waits = 0
+        self.waitTime = 0
+
         # Used in averaging the last execution times.
         self.executionTimeSamples = []
         self.averageExecutionTime = None
 
-        # This gets changed by _updateWorkSize.
+        # This gets changed by _updateWorkSize, or _autotune.
         self.executionSize = None
 
-        # Statistics accessed by the dedicated thread.
+        # Statistics accessed by the dedicated thread. If the kernel gives up
+        # on the current range part of the way through, covered is how many
+        # of its nonces it got through.
         self.currentData = None
         self.startedAt = time()
+        self.covered = None
+
+        # The dedicated thread leaves records of (nonces hashed, execution
+        # time, wait time) here, and the main thread picks them up in batches. The
+        # main thread is only woken up when it hasn't been already.
+        self.handoff = deque()
+        self.handoffLock = Lock()
+        self.drainScheduled = False
 
     def start(self):
         """Called by the kernel when it's actually starting."""
+        self._stopped = False
         self._updateWorkSize(None, None)
         self._requestMore()
 
@@ -73,6 +151,7 @@ class QueueReader(object):
         the loop running in the mining thread.
         """
         # Tell the other thread to exit cleanly.
+        self._stopped = True
         while not self.dataQueue.empty():
             try:
                 self.dataQueue.get(False)
@@ -80,40 +159,84 @@ class QueueReader(object):
                 pass
         self.dataQueue.put(StopIteration())
 
-    def _ranExecution(self, nr, dt):
-        """An internal function called after an execution completes, with the
-        time it took. Used to keep track of the time so kernels can use it to
-        tune their execution times.
+    def abort(self, covered):
+        """Called from the dedicated thread when the kernel stops working on
+        the current range early (e.g. because it went stale), with how many of
+        its nonces it did get through. Only those count towards the hashrate
+        and tuning.
+        """
+        self.covered = covered
+
+    def _ranExecutions(self, executions):
+        """An internal function called after executions complete, with a list
+        of (nonces hashed, time it took). Used to keep track of the time so
+        kernels can use it to tune their execution times.
         """
 
-        if dt > 0:
-            self.interface.updateRate(int(nr.size/dt/1000), self.index)
+        size = sum(size for size, dt in executions)
+        elapsed = sum(dt for size, dt in executions)
+        if elapsed > 0:
+            self.interface.updateRate(int(size/elapsed/1000), self.index)
 
-        self.executionTimeSamples.append(dt)
+        if self.tuner:
+            self._autotune(executions)
+            return
+
+        lastSize = executions[-1][0]
+        self.executionTimeSamples.extend(dt for size, dt in executions)
         self.executionTimeSamples = self.executionTimeSamples[-self.SAMPLES:]
 
         if len(self.executionTimeSamples) == self.SAMPLES:
             averageExecutionTime = (sum(self.executionTimeSamples) /
                                     len(self.executionTimeSamples))
 
-            self._updateWorkSize(averageExecutionTime, nr.size)
+            self._updateWorkSize(averageExecutionTime, lastSize)
 
     def _updateWorkSize(self, time, size):
         """An internal function that tunes the executionSize to that specified
         by the workSizeCallback; which is in turn passed the average of the
         last execution times.
         """
-        if self.workSizeCallback:
+        if self.tuner:
+            if self.executionSize is None:
+                self.executionSize = self.tuner.size
+        elif self.workSizeCallback:
             self.executionSize = self.workSizeCallback(time, size)
 
+    def _autotune(self, executions):
+        """An internal function that picks the executionSize for the
+        targetTime with the WorkSizeTuner.
+        """
+
+        self.tuner.add(executions)
+        self.executionSize = self.tuner.size
+
+        if self.tuner.averageTime is not None:
+            self.interface.setStat('worksize', self.executionSize)
+            self.interface.setStat('executiontime',
+                                   round(self.tuner.averageTime, 4))
+
+    def _waited(self, waits):
+        """Called in the main thread with a list of how many seconds the
+        dedicated thread had to wait for work each time it did.
+        """
+        self.waits += len(waits)
+        self.waitTime += sum(waits)
+        self.interface.setStat('prefetchwaits', self.waits)
+        self.interface.setStat('prefetchwaittime', round(self.waitTime, 3))
+
     def _requestMore(self):
-        """This is used to start the process of making a new item available in
-        the dataQueue, so the dedicated thread doesn't have to block.
+        """This is used to start the process of making new items available in
+        the dataQueue, so the dedicated thread doesn't have to block. Items
+        that are still being fetched count towards the depth.
         """
 
-        # This should only run if there's no ready-to-go work in the queue.
-        if not self.dataQueue.empty():
-            return
+        while (not self._stopped and
+               self.dataQueue.qsize() + self.pending < self.depth):
+            self._fetch()
+
+    def _fetch(self):
+        self.pending += 1
 
         if self.executionSize is None:
             d = self.interface.fetchRange()
@@ -121,6 +244,9 @@ class QueueReader(object):
             d = self.interface.fetchRange(self.executionSize)
 
         def preprocess(nr):
+            # Don't bother preprocessing work that went stale on the way.
+            if nr.unit.isStale:
+                return None
             nr.unit.addStaleCallback(self._staleCallback)
 
             # If preprocessing is not necessary, just tuplize right away.
@@ -136,30 +262,70 @@ class QueueReader(object):
             return d2
         d.addCallback(preprocess)
 
-        d.addCallback(self.dataQueue.put_nowait)
+        def ready(item):
+            self.pending -= 1
+            if item is None or item[1].unit.isStale:
+                self._requestMore()
+            elif not self._stopped:
+                self.dataQueue.put_nowait(item)
+        d.addCallback(ready)
 
     def _staleCallback(self, wu):
         """Called when a WorkUnit is rendered stale and no more work should be
         done on it.
         """
 
+        # Out with the old...
         notStale = []
-        if not self.dataQueue.empty():
-            # Out with the old...
-            while not self.dataQueue.empty():
-                try:
-                    nr = self.dataQueue.get(False)
-                    if nr[1].unit != wu:
-                        notStale.append(nr)
-                except Empty: continue
-            # ...in with the new.
-            if notStale:
-                # Put all of the non-stale items back into the queue...
-                for nr in notStale:
-                    self.dataQueue.put_nowait(nr)
-            else:
-                # It's totally empty, ask the WorkQueue for more.
-                self._requestMore()
+        while not self.dataQueue.empty():
+            try:
+                nr = self.dataQueue.get(False)
+                if isinstance(nr, StopIteration) or nr[1].unit != wu:
+                    notStale.append(nr)
+            except Empty: continue
+
+        # ...in with the new. Put all of the non-stale items back into the
+        # queue, and ask the WorkQueue for enough to fill it up again.
+        for nr in notStale:
+            self.dataQueue.put_nowait(nr)
+        self._requestMore()
+
+    def _handOff(self, *records):
+        """Called from the dedicated thread to pass records (None is skipped)
+        to the main thread, and make sure that it will drain the handoff queue.
+        """
+        self.handoffLock.acquire()
+        try:
+            self.handoff.extend(r for r in records if r is not None)
+            if self.drainScheduled:
+                return
+            self.drainScheduled = True
+        finally:
+            self.handoffLock.release()
+
+        reactor.callFromThread(self._drain)
+
+    def _drain(self):
+        """Runs in the main thread to process everything the dedicated thread
+        has handed off since the last time, and restock the dataQueue.
+        """
+        self.handoffLock.acquire()
+        try:
+            records = list(self.handoff)
+            self.handoff.clear()
+            self.drainScheduled = False
+        finally:
+            self.handoffLock.release()
+
+        executions = [(size, dt) for size, dt, wait in records
+                      if size is not None]
+        if executions:
+            self._ranExecutions(executions)
+        waits = [wait for size, dt, wait in records if wait is not None]
+        if waits:
+            self._waited(waits)
+
+        self._requestMore()
 
     def __iter__(self):
         return self
@@ -170,25 +336,45 @@ class QueueReader(object):
         main thread.
         """
 
-        # If we just completed a range, we should tell the main thread.
+        # If we just completed a range, we should tell the main thread. This
+        # goes along with the restocking request below, so it only takes one
+        # trip to the main thread.
+        ran = None
         if self.currentData:
             # self.currentData[1] is the un-preprocessed NonceRange.
             now = time()
             dt = now - self.startedAt
             self.startedAt = now
-            reactor.callFromThread(self._ranExecution, self.currentData[1], dt)
+            covered = self.currentData[1].size
+            if self.covered is not None:
+                covered = self.covered
+                self.covered = None
+            # A range that was given up on straight away tells us nothing.
+            if covered:
+                ran = (covered, dt, None)
 
         # Block for more data from the main thread. In 99% of cases, though,
         # there should already be something here.
         # Note that this comes back with either a tuple, or a StopIteration()
-        self.currentData = self.dataQueue.get(True)
+        waited = None
+        try:
+            self.currentData = self.dataQueue.get(False)
+        except Empty:
+            # There's nothing to do until more work shows up, so there's no
+            # harm in waking the main thread up straight away.
+            if ran is not None:
+                self._handOff(ran)
+                ran = None
+            waitStarted = time()
+            self.currentData = self.dataQueue.get(True)
+            waited = (None, None, time() - waitStarted)
 
         # Does the main thread want us to shut down, or pass some more data?
         if isinstance(self.currentData, StopIteration):
             raise self.currentData
 
-        # We just took the only item in the queue. It needs to be restocked.
-        reactor.callFromThread(self._requestMore)
+        # We just took an item from the queue. It needs to be restocked.
+        self._handOff(ran, waited)
 
         # currentData is actually a tuple, with item 0 intended for the kernel.
         return self.currentData[0]